@@ -0,0 +1,335 @@
+#########################################
+# Benchmarks for branch_manager_report  #
+# Synthetic data, no database needed    #
+#########################################
+# Times each report stage on synthetic activity data shaped like the branch_manager_report_query output,
+# plus an end-to-end run of all branches with emails sent to the local stand-in SMTP server and S3 uploads
+# replaced by a client that only reads the files.
+#
+# Run from the repository root:
+#   python benchmarks/benchmark_pipeline.py --branches 20 --users 3000 --output benchmark_results.json
+#   python benchmarks/benchmark_pipeline.py --compare benchmark_baseline.json
+import datetime as dt
+import os
+import sys
+import getopt
+import json
+import io
+import contextlib
+import tempfile
+import platform
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import branch_manager_report as bmr  # noqa: E402
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+
+help_text = '''
+usage: benchmark_pipeline [option]
+Options:
+-h   : Print this help message and exit
+--branches N : Number of branches (default 10)
+--users N : Number of users over all branches (default 2000)
+--tracks N : Number of tracks (default 5)
+--weeks N : Number of weeks of activity, ending today (default 15, as in the report)
+--lessons_per_week N : Average lessons entered per user and week (default 2)
+--repeats N : Runs of each stage, the median is reported (default 3)
+--workers N : Render worker processes in the end-to-end run (default 1)
+--chart_format FORMAT : Chart format of the end-to-end run, png, svg or html (default png)
+--seed N : Random seed of the synthetic data (default 0)
+--output PATH : Results JSON file (default benchmark_results.json)
+--compare PATH : Compare the results with a baseline results file and exit with an error on regressions
+--tolerance X : Allowed slowdown against the baseline before a stage is flagged (default 0.2 = 20%)
+'''
+
+benchmark_roles = ["student", "student", "student", "student", "editingteacher", "manager"]
+benchmark_team_roles = ["manager", "editingteacher"]
+
+
+# Config with the keys the report reads, pointing the output and log to the benchmark folder
+def benchmark_config(benchmark_folder):
+    return {"db_login": {"User": "", "Pass": "", "Database": "", "Host": "localhost", "Port": 3306},
+            "email_login": {"User": "benchmark@localhost", "Oauth_2.0_file": "oauth2.json"},
+            "query_fields": {"role": "roleName", "role_ID": "role_ID", "user_first_name": "firstname_eng",
+                             "user_last_name": "lastname_eng", "email": "email", "enroll": "dateJoined",
+                             "branch_id": "branchID", "branch": "branchName"},
+            "team_values": {"values": benchmark_team_roles},
+            "s3_login": {"aws_access_key_id": "", "aws_secret_access_key": "", "region_name": "us-east-1",
+                         "service_name": "s3", "bucket_name": "benchmark"},
+            "output": {"log_filename": os.path.join(benchmark_folder, "benchmark_error.log"),
+                       "branch_data_url": "", "folder_name": os.path.join(benchmark_folder, "output"),
+                       "cache_folder": os.path.join(benchmark_folder, "weekly_cache")}}
+
+
+# Synthetic activity rows with the columns and value formats of the report query.
+# Each user belongs to one branch, has one role and studies one or two tracks.
+def synthetic_activity(branches=10, users=2000, tracks=5, weeks=15, lessons_per_week=2, seed=0):
+    random_generator = np.random.default_rng(seed)
+    date_end = dt.date.today()
+    date_begin = date_end - dt.timedelta(weeks=weeks)
+    track_names = ["Track %d" % track_no for track_no in range(tracks)]
+    user_ids = np.arange(1, users + 1)
+    user_branch = random_generator.integers(0, branches, users)
+    user_role = random_generator.integers(0, len(benchmark_roles), users)
+    user_joined = [str(date_begin - dt.timedelta(days=int(days))) for days in
+                   random_generator.integers(0, 365, users)]
+
+    rows = users * weeks * lessons_per_week
+    row_user = random_generator.integers(0, users, rows)
+    row_track = (user_ids[row_user] + random_generator.integers(0, 2, rows)) % tracks  # One or two tracks per user
+    row_day = random_generator.integers(0, (date_end - date_begin).days + 1, rows)
+    return pd.DataFrame({
+        "userID": user_ids[row_user],
+        "firstname_eng": ["first%d" % user_id for user_id in user_ids[row_user]],
+        "lastname_eng": ["last%d" % user_id for user_id in user_ids[row_user]],
+        "email": ["user%d@example.org" % user_id for user_id in user_ids[row_user]],
+        "dateJoined": [user_joined[user_no] for user_no in row_user],
+        "track": [track_names[track_no] for track_no in row_track],
+        "lessonDate": [str(date_begin + dt.timedelta(days=int(days))) for days in row_day],
+        "lessonNo": random_generator.integers(1, 40, rows),
+        "branchID": user_branch[row_user],
+        "branchName": ["Branch %d" % branch_code for branch_code in user_branch[row_user]],
+        "role_ID": user_role[row_user],
+        "roleName": [benchmark_roles[role_no] for role_no in user_role[row_user]]}), date_begin, date_end
+
+
+# Branch list in the shape of the branch data JSON
+def synthetic_branch_list(activity_df):
+    return [{"id": int(branch_code), "branch_name": "Branch %d" % branch_code, "branch_email": "branch@localhost",
+             "branch_type": 2} for branch_code in sorted(activity_df["branchID"].unique())]
+
+
+# Stand-in S3 client - reads the file or in-memory buffer instead of uploading it
+class ReadOnlyS3Client:
+    def upload_file(self, file_name, bucket_name, key, Config=None):
+        with open(file_name, "rb") as upload_file:
+            upload_file.read()
+
+    def upload_fileobj(self, fileobj, bucket_name, key, Config=None):
+        fileobj.read()
+
+
+# Times a stage - setup builds fresh inputs outside the timing, stage runs on them
+# Output - median, min and all run times in seconds
+def time_stage(setup, stage, repeats):
+    run_seconds = []
+    for _ in range(repeats):
+        stage_input = setup()
+        stage_start = time.perf_counter()
+        stage(stage_input)
+        run_seconds.append(time.perf_counter() - stage_start)
+    return {"median_seconds": float(np.median(run_seconds)), "min_seconds": min(run_seconds),
+            "runs": run_seconds}
+
+
+# Prepared per branch inputs - activity slice with week labels, users and summary table
+def branch_inputs(activity_df, users_df, branch_counts, fields_dict, start_week_dates, end_week_dates):
+    inputs = []
+    for branch_code, df_branch in bmr.split_by_branch(activity_df, fields_dict).items():
+        [all_participants_df, by_track_df] = bmr.branch_counts_slice(branch_counts, branch_code,
+                                                                     "Total participants+staff")
+        [df_branch_user, all_week_names] = bmr.activity_by_user(df_branch.copy(), "lessonDate", "userID",
+                                                                start_week_dates, end_week_dates)
+        inputs.append({"branch_code": branch_code, "df_branch": df_branch, "df_branch_user": df_branch_user,
+                       "all_week_names": all_week_names, "users_df": bmr.branch_users_for(users_df, df_branch),
+                       "table_totals": pd.concat([all_participants_df, by_track_df], axis=0)})
+    return inputs
+
+
+# Saves the summary and progress table of each branch as CSV
+def save_branch_tables(table_list, csv_folder):
+    for branch_input, progress_table in table_list:
+        bmr.save_as_csv(os.path.join(csv_folder, "summary %d.csv" % branch_input["branch_code"]),
+                        branch_input["table_totals"])
+        bmr.save_as_csv(os.path.join(csv_folder, "progress %d.csv" % branch_input["branch_code"]), progress_table)
+
+
+# Runs every stage benchmark
+# Output - results dictionary, stages keyed by name
+def run_benchmarks(parameters, benchmark_folder):
+    repeats = parameters["repeats"]
+    bmr.load_config(write_benchmark_config(benchmark_folder))
+    fields_dict = bmr.query_fields_details
+    [raw_df, date_begin, date_end] = synthetic_activity(parameters["branches"], parameters["users"],
+                                                        parameters["tracks"], parameters["weeks"],
+                                                        parameters["lessons_per_week"], parameters["seed"])
+    [start_week_dates, end_week_dates] = bmr.week_date_start_end(date_begin, date_end)
+    [activity_df, users_df] = bmr.prepare_activity_data(raw_df.copy(), fields_dict, start_week_dates,
+                                                        end_week_dates)
+    branch_counts = bmr.branch_activity_counts(activity_df, fields_dict, "track", "lessonDate", "userID",
+                                               start_week_dates, end_week_dates)
+    inputs = branch_inputs(activity_df, users_df, branch_counts, fields_dict, start_week_dates, end_week_dates)
+    csv_folder = os.path.join(benchmark_folder, "csv")
+    os.makedirs(csv_folder, exist_ok=True)
+
+    stages = {}
+    # Whole table stages
+    stages["enforce_activity_schema"] = time_stage(
+        lambda: raw_df.copy(), lambda df: bmr.enforce_activity_schema(df, fields_dict), repeats)
+    typed_df = bmr.enforce_activity_schema(raw_df.copy(), fields_dict)
+    stages["convert_role"] = time_stage(
+        lambda: typed_df.copy(), lambda df: bmr.convert_role(df, fields_dict, bmr.team_role_details), repeats)
+    stages["convert_track_opening"] = time_stage(
+        lambda: typed_df.copy(), lambda df: bmr.convert_track_opening(df, "dateJoined"), repeats)
+    stages["split_user_dimension"] = time_stage(
+        lambda: typed_df.copy(), lambda df: bmr.split_user_dimension(df, fields_dict, bmr.team_role_details),
+        repeats)
+    stages["branch_activity_counts"] = time_stage(
+        lambda: activity_df, lambda df: bmr.branch_activity_counts(df, fields_dict, "track", "lessonDate",
+                                                                   "userID", start_week_dates, end_week_dates),
+        repeats)
+
+    # Per branch stages - time over all branches
+    def each_branch(branch_stage):
+        return lambda branch_list: [branch_stage(branch_input) for branch_input in branch_list]
+
+    stages["activity_total"] = time_stage(lambda: inputs, each_branch(lambda branch_input: bmr.activity_total(
+        branch_input["df_branch"], "lessonDate", "userID", start_week_dates, end_week_dates,
+        "Total participants+staff")), repeats)
+    stages["activity_by_track"] = time_stage(lambda: inputs, each_branch(lambda branch_input: bmr.activity_by_track(
+        branch_input["df_branch"], "track", "lessonDate", "userID", start_week_dates, end_week_dates)), repeats)
+    stages["activity_by_user"] = time_stage(lambda: inputs, each_branch(lambda branch_input: bmr.activity_by_user(
+        branch_input["df_branch"].copy(), "lessonDate", "userID", start_week_dates, end_week_dates)), repeats)
+    stages["progress_table_generator"] = time_stage(
+        lambda: inputs, each_branch(lambda branch_input: bmr.progress_table_generator(
+            branch_input["df_branch_user"].copy(), branch_input["users_df"], branch_input["all_week_names"])),
+        repeats)
+    stages["branch_summary_graph"] = time_stage(
+        lambda: inputs, each_branch(lambda branch_input: bmr.branch_summary_graph(
+            branch_input["table_totals"], os.path.join(benchmark_folder, "chart"))), repeats)
+    stages["branch_summary_svg"] = time_stage(
+        lambda: inputs, each_branch(lambda branch_input: bmr.branch_summary_svg(branch_input["table_totals"])),
+        repeats)
+    stages["branch_summary_html"] = time_stage(
+        lambda: inputs, each_branch(lambda branch_input: bmr.branch_summary_html(branch_input["table_totals"])),
+        repeats)
+    progress_tables = [bmr.progress_table_generator(branch_input["df_branch_user"].copy(), branch_input["users_df"],
+                                                    branch_input["all_week_names"]) for branch_input in inputs]
+    stages["csv_writing"] = time_stage(lambda: list(zip(inputs, progress_tables)),
+                                       lambda table_list: save_branch_tables(table_list, csv_folder), repeats)
+    stages["csv_buffers"] = time_stage(
+        lambda: list(zip(inputs, progress_tables)),
+        lambda table_list: [(bmr.table_as_csv_bytes(branch_input["table_totals"]),
+                             bmr.table_as_csv_bytes(progress_table)) for branch_input, progress_table in table_list],
+        repeats)
+
+    # End to end - cleanup, counts, rendering and delivery of all branches
+    stages["end_to_end"] = time_stage(
+        lambda: raw_df.copy(),
+        lambda df: end_to_end_run(df, fields_dict, start_week_dates, end_week_dates, parameters["workers"],
+                                  parameters["chart_format"]), repeats)
+
+    return {"created": str(dt.datetime.now()), "parameters": parameters, "rows": len(raw_df),
+            "environment": {"python": platform.python_version(), "pandas": pd.__version__,
+                            "numpy": np.__version__, "platform": platform.platform()},
+            "stages": stages}
+
+
+# Config file for load_config in the benchmark folder
+def write_benchmark_config(benchmark_folder):
+    config_path = os.path.join(benchmark_folder, "config.json")
+    with open(config_path, "w") as config_file:
+        json.dump(benchmark_config(benchmark_folder), config_file)
+    return config_path
+
+
+# Full report run of all branches - emails go to the local stand-in SMTP server, S3 uploads only read the files
+# Raises RuntimeError if any branch fails, so failed runs are never timed as results
+def end_to_end_run(raw_df, fields_dict, start_week_dates, end_week_dates, workers, chart_format):
+    bmr.retrieve_all_branch_codes_and_emails = lambda url: synthetic_branch_list(raw_df)
+    bmr.s3_client = ReadOnlyS3Client()
+    [smtp_server, smtp_port] = bmr.start_local_smtp_server()
+    bmr.open_smtp_pool(bmr.email_details, pool_size=2, local_smtp_port=smtp_port)
+    try:
+        [activity_df, users_df] = bmr.prepare_activity_data(raw_df, fields_dict, start_week_dates, end_week_dates)
+        with contextlib.redirect_stdout(io.StringIO()):  # Run summary table
+            failed_branches = bmr.generate_report_for_all_branches(
+                activity_df, start_week_dates, end_week_dates, fields_dict, bmr.email_title, bmr.email_content,
+                workers=workers, users_df=users_df, chart_format=chart_format)
+        if failed_branches is None:
+            raise RuntimeError("End to end run failed, see the error log")
+        if failed_branches:
+            raise RuntimeError("End to end run failed for branches: " +
+                               ", ".join(str(code) for code in failed_branches))
+    finally:
+        bmr.close_smtp_pool()
+        smtp_server.shutdown()
+
+
+# Compares results with a baseline, a stage is a regression when its median is slower by more than tolerance
+# Output - names of regressed stages
+def compare_with_baseline(results, baseline, tolerance=0.2):
+    regressions = []
+    print("%-26s %12s %12s %8s" % ("stage", "baseline s", "current s", "ratio"))
+    for stage_name, stage_result in results["stages"].items():
+        if stage_name not in baseline["stages"]:
+            print("%-26s %12s %12.4f %8s" % (stage_name, "-", stage_result["median_seconds"], "new"))
+            continue
+        baseline_seconds = baseline["stages"][stage_name]["median_seconds"]
+        ratio = stage_result["median_seconds"] / baseline_seconds if baseline_seconds > 0 else float("inf")
+        regressed = ratio > 1 + tolerance
+        if regressed:
+            regressions.append(stage_name)
+        print("%-26s %12.4f %12.4f %8.2f%s" % (stage_name, baseline_seconds, stage_result["median_seconds"], ratio,
+                                               "  REGRESSION" if regressed else ""))
+    if results["parameters"] != baseline.get("parameters"):
+        print("Note: benchmark parameters differ from the baseline")
+    return regressions
+
+
+def main(argv):
+    parameters = {"branches": 10, "users": 2000, "tracks": 5, "weeks": 15, "lessons_per_week": 2, "repeats": 3,
+                  "workers": 1, "chart_format": "png", "seed": 0}
+    output_file = "benchmark_results.json"
+    baseline_file = ""
+    tolerance = 0.2
+    try:
+        options, args = getopt.getopt(argv, "h", ["branches=", "users=", "tracks=", "weeks=", "lessons_per_week=",
+                                                  "repeats=", "workers=", "chart_format=", "seed=", "output=",
+                                                  "compare=", "tolerance="])
+    except getopt.GetoptError:
+        print(help_text)
+        sys.exit(2)
+
+    for opt, arg in options:
+        if opt == "-h":
+            print(help_text)
+            sys.exit()
+        elif opt == "--chart_format":
+            parameters["chart_format"] = arg.lower()
+        elif opt == "--output":
+            output_file = arg
+        elif opt == "--compare":
+            baseline_file = arg
+        elif opt == "--tolerance":
+            tolerance = float(arg)
+        else:
+            parameters[opt[2:]] = int(arg)
+
+    with tempfile.TemporaryDirectory() as benchmark_folder:
+        try:
+            results = run_benchmarks(parameters, benchmark_folder)
+        except RuntimeError as error:
+            print(error)
+            sys.exit(1)
+    with open(output_file, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+    print("%d rows, %d branches, %d users" % (results["rows"], parameters["branches"], parameters["users"]))
+    for stage_name, stage_result in results["stages"].items():
+        print("%-26s median %.4fs  min %.4fs" % (stage_name, stage_result["median_seconds"],
+                                                stage_result["min_seconds"]))
+    print("Results saved to " + output_file)
+
+    if baseline_file:
+        with open(baseline_file) as baseline_json:
+            baseline = json.load(baseline_json)
+        regressions = compare_with_baseline(results, baseline, tolerance)
+        if regressions:
+            print("Regressions over %d%%: %s" % (tolerance * 100, ", ".join(regressions)))
+            sys.exit(1)
+        print("No regressions over %d%%" % (tolerance * 100))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -3,21 +3,51 @@
 # By: Dr. Doreen Ben-Zvi                #
 # Aug 2020                              #
 #########################################
-import pandas as pd
-import numpy as np
 import datetime as dt
-import dateutil.rrule as rrule
-import dateutil.relativedelta as relativedelta
-import mysql.connector  # Install mysql-connector-python
-import matplotlib.pyplot as plt
-import yagmail
 import logging
 import os
-import boto3
 import sys
 import getopt
 import json
-import urllib3
+import contextlib
+import importlib.util
+import concurrent.futures
+import itertools
+import queue
+import threading
+import time
+import smtplib
+import socketserver
+import html
+import subprocess
+import functools
+import hashlib
+import io
+import re
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Not available on Windows - peak memory is not reported there
+    resource = None
+
+
+# Imports a module on first attribute access, so -h/-a and argument errors do not pay for heavy imports.
+# mysql.connector, yagmail, boto3 and urllib3 are imported inside the functions that use them.
+def lazy_module(module_name):
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    module_spec = importlib.util.find_spec(module_name)
+    loader = importlib.util.LazyLoader(module_spec.loader)
+    module_spec.loader = loader
+    module = importlib.util.module_from_spec(module_spec)
+    sys.modules[module_name] = module
+    loader.exec_module(module)
+    return module
+
+
+pd = lazy_module("pandas")
+np = lazy_module("numpy")
 
 # Set global variables
 help_text = '''
@@ -29,6 +59,51 @@ Options:
 -b   : Test mode, specify branch report to send
         Cannot be used without specifying report recipient Email address. 
 -a   : About this report script
+-w   : Number of worker processes rendering branch reports in parallel (default 1)
+        Long form: --workers N
+-d   : Number of delivery threads sending emails and uploading to AWS while reports render (default 2)
+        0 delivers each report right after it is rendered. Long form: --delivery_workers N
+        Each delivery thread reuses one SMTP session for the whole run
+--local_smtp : Send all emails to a built-in local stand-in SMTP server (offline benchmarking)
+--s3_batch : Upload the files of all branches to AWS in one pass at the end of the run
+--fetch_chunk N : Fetch query results in batches of N rows instead of all at once. Each batch is cast to compact
+        types as it arrives, so the full result is only held in its compact form (about twice that at peak while
+        batches are combined) - with --partition_folder memory is bounded by N
+--partition_folder PATH : Stream query results into one folder of Parquet files per branch in PATH (batches of
+        --fetch_chunk rows, default 50000). Each branch is loaded only when its report is rendered. Bypasses the
+        weekly cache
+--refresh : Re-query all weeks from the database instead of reading closed weeks from the weekly cache
+--sql_aggregate : Compute weekly counts and max lesson per user in MySQL and retrieve only aggregated rows
+--parity_check : Build all branch tables with the row level and the aggregated query, report differences and exit
+--explain : Print the EXPLAIN plan of the branch report query and the indexes it needs, then exit
+--time_query N : Run the prepared branch report query N times and print its latency, then exit
+--db_parallel N : Split the date range into Sunday-start week partitions and query N of them at once
+        on separate connections (set PoolSize in db_login to at least N)
+--partition_weeks N : Weeks per partition with --db_parallel (default 1)
+--chart_format FORMAT : Branch summary chart as png (default, matplotlib attachment), svg (small SVG attachment)
+        or html (bars drawn as an HTML table in the email body, no chart attachment - Gmail strips inline SVG).
+        svg and html do not load matplotlib
+--skip_unchanged : Reuse the files of branches whose input data and week range did not change since the last run
+        (Artifact manifest.json in the output folder) and do not send them again if already sent to the same address.
+        Set "skip_existing": true in the transfer block of s3_login to also skip uploading files already in S3
+--s3_archive : Also archive the summary counts and per user progress rows of all branches as one compressed Parquet
+        dataset per run, under <prefix>/run=<date>/ in the bucket (s3_login.archive.prefix, default "archive").
+        Rows are sorted by branch and week with one row group per branch. Renders every branch (no --skip_unchanged)
+        Runs and date prefixed backups older than s3_login.archive.retention_days are deleted at the end of every run
+--backfill FROM[:TO] : Regenerate the reports of every week from FROM to TO (YYYY-MM-DD, TO defaults to today) and
+        exit, e.g. --backfill 2026-01-01:2026-03-01. The data of all weeks is retrieved and counted once, and each
+        week's report covers the 15 weeks ending with that week, as a regular run on its Saturday would. Files are
+        saved to "Backfill <week start>" folders in the output folder and are not sent or uploaded. Uses --workers,
+        --chart_format and the retrieval options
+--in_memory : Keep the report files of each branch in memory only - email attachments and AWS uploads are fed from
+        the same buffers and nothing is written to the output folder. Without it a copy is saved there as well
+--profile : Also save cProfile statistics of the main process as Run profile.prof/txt in the output folder, and
+        trace memory to record the peak of each stage call (stage_peak_mb, slows the run down about 2.5x).
+        Every run saves per stage and per branch timings, rows and the process peak RSS as Run stages.csv/json
+--startup_check MS : Time -h and -a in a fresh interpreter with -X importtime, list the slowest imports and exit
+        with an error if either takes longer than MS milliseconds. Does not need the config file
+--chart_benchmark N : Render the branch summary chart N times from a synthetic table and print the time per chart,
+        then exit. Uses --chart_format. PNG size and DPI are set by output.chart_size and output.chart_dpi in config
 '''
 
 about_text = '''
@@ -40,36 +115,56 @@ Branch Manager Report v1.0 Aug 20 Doreen Ben-Zvi
 4. User specific table displaying maximal lesson studied by each user in each track during each week in the date range.
 5. Branch emails retrieved.
 6. 2-4 are sent to the appropriate branch
-7. 2-4 are copied to AWS as archive (Backup limit is set to #TODO add limit)
+7. 2-4 are copied to AWS as archive. With --s3_archive the tables of all branches are also archived as one Parquet
+   dataset per run. Backups older than s3_login.archive.retention_days are deleted (kept if not set)
+
+Lessons of closed weeks are cached locally as Parquet (output.cache_folder in config), only new weeks are queried.
+Names, branch and role of the users are queried on every run, so branch membership is as of the time of the run.
 
 v1.0  Includes: loading from config file, command line options, error log, output save to separate folder
 '''
 
-# Load Config file
+# Config file - loaded by load_config from main, the globals read from it are None until then
 config_file_name = "config.json"
-with open(config_file_name) as config_file:
-    config_data = json.load(config_file)
+config_data = None
 
 # Set global variables
-log_filename = config_data["output"]["log_filename"]
+log_filename = None
 log_template = "%s %s failed at function %s"
 log_template_with_branch = "%s %s failed at function %s during branch %s report"
-logging.basicConfig(filename=log_filename, level=logging.ERROR)
+run_logger = logging.getLogger("branch_manager_report")  # Run information (memory, timings) - errors only on root
+run_logger.setLevel(logging.INFO)
 
-sql_details = config_data["db_login"]
+sql_details = None
 username_key = "User"
 password_key = "Pass"
 database_key = "Database"
 host_key = "Host"
 port_key = "Port"
-
-email_details = config_data["email_login"]
-query_fields_details = config_data["query_fields"]
-team_role_details = config_data["team_values"]["values"]
-s3_details = config_data["s3_login"]
-
-branch_data_url = config_data["output"]["branch_data_url"]
-output_folder_name = config_data["output"]["folder_name"]
+pool_size_key = "PoolSize"
+
+email_details = None
+oauth2_file_path = None
+query_fields_details = None
+team_role_details = None
+s3_details = None
+
+branch_data_url = None
+output_folder_name = None
+cache_folder_name = "weekly_cache"
+week_index_col = "lesson_week_index"
+chart_dpi = 100
+chart_size = (40, 10)  # Inches
+chart_figure_template = {}  # Figure and axes reused by every chart rendered in this process
+chart_formats = ("png", "svg", "html")
+svg_colors = ["#1f77b4", "#ff7f0e", "#2ca02c", "#9467bd", "#8c564b", "#e377c2", "#7f7f7f", "#bcbd22", "#17becf"]
+default_chunk_size = 50000
+report_query_columns = ["userID", "firstname_eng", "lastname_eng", "email", "dateJoined", "track", "lessonDate",
+                        "lessonNo", "branchID", "branchName", "role_ID", "roleName"]
+lesson_fact_columns = ["userID", "track", "lessonDate", "lessonNo"]  # Columns kept in the weekly cache
+artifact_manifest_name = "Artifact manifest.json"
+archive_file_names = ("branch_summary.parquet", "user_progress.parquet")  # Tables of the run archive
+report_window_weeks = 15  # Weeks in each backfilled report
 
 email_title = 'דו"ח שבועי למנהלות סניף ' + "%s"
 email_content = '''
@@ -81,6 +176,31 @@ email_content = '''
 '''
 
 
+# Loads the config file into the global variables and sets up the error log
+# Also the initializer of render worker processes, so they work with any process start method
+def load_config(file_name=config_file_name):
+    global config_file_name, config_data, log_filename, sql_details, email_details, oauth2_file_path, \
+        query_fields_details, team_role_details, s3_details, branch_data_url, output_folder_name, cache_folder_name, \
+        chart_dpi, chart_size
+    with open(file_name) as config_file:
+        config_data = json.load(config_file)
+    config_file_name = file_name  # Passed on to render worker processes
+    log_filename = config_data["output"]["log_filename"]
+    logging.basicConfig(filename=log_filename, level=logging.ERROR)
+    sql_details = config_data["db_login"]
+    email_details = config_data["email_login"]
+    oauth2_file_path = os.path.abspath(email_details["Oauth_2.0_file"])  # Resolved once against the start directory
+    query_fields_details = config_data["query_fields"]
+    team_role_details = config_data["team_values"]["values"]
+    s3_details = config_data["s3_login"]
+    branch_data_url = config_data["output"]["branch_data_url"]
+    output_folder_name = config_data["output"]["folder_name"]
+    cache_folder_name = config_data["output"].get("cache_folder", "weekly_cache")
+    chart_dpi = config_data["output"].get("chart_dpi", 100)
+    chart_size = tuple(config_data["output"].get("chart_size", [40, 10]))
+    return config_data
+
+
 def load_contents_from_txt(filename):
     try:
         f = open(filename, "r")
@@ -151,12 +271,201 @@ def save_as_csv(file_name, table):
             "save_as_csv"))
 
 
+# Table as csv bytes - the same content save_as_csv writes to file
+def table_as_csv_bytes(table):
+    return table.to_csv(index=True).encode('utf-8-sig')
+
+
+# Saves rendered artifacts - (file name, content) pairs - to folder
+# Output - full paths of the saved files
+def save_artifacts(artifacts, folder_name):
+    file_list = []
+    try:
+        os.makedirs(folder_name, exist_ok=True)
+        for file_name, content in artifacts:
+            file_path = os.path.abspath(os.path.join(folder_name, file_name))
+            with open(file_path, "wb") as artifact_file:
+                artifact_file.write(content)
+            file_list.append(file_path)
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Saving report files",
+            "save_artifacts"))
+    return file_list
+
+
+# Report files are either paths on disk or in-memory (file name, content) pairs
+def artifact_name(artifact):
+    return artifact[0] if isinstance(artifact, tuple) else os.path.basename(artifact)
+
+
+# Email attachment / S3 upload source of an artifact - a named buffer over in-memory content, else the full path
+def artifact_source(artifact):
+    if isinstance(artifact, tuple):
+        buffer = io.BytesIO(artifact[1])
+        buffer.name = artifact[0]  # yagmail names the attachment after the buffer
+        return buffer
+    return os.path.abspath(artifact)
+
+
+def artifact_size(artifact):
+    return len(artifact[1]) if isinstance(artifact, tuple) else os.path.getsize(artifact)
+
+
+def artifact_content_hash(artifact, algorithm="sha256"):
+    if isinstance(artifact, tuple):
+        return hashlib.new(algorithm, artifact[1]).hexdigest()
+    return file_content_hash(artifact, algorithm)
+
+
+# Stage records of this run - wall time, rows processed and peak memory of each stage call
+stage_records = []
+stage_records_lock = threading.Lock()
+stage_context = threading.local()  # Branch being processed by this thread, and the render job record list
+traced_stages = {}  # Stage calls in progress while tracemalloc is on - [traced memory at start, peak so far]
+traced_stage_ids = itertools.count()
+
+
+# Peak resident memory of this process since it started in MB, None where the resource module is missing
+def process_peak_rss_mb():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)  # Bytes on macOS, KB on Linux
+
+
+# Folds the traced memory peak since the last reset into every stage in progress, then resets it.
+# reset_peak is process wide, so stages running at the same time (threads, nested stages) share the folded peaks.
+# Called with stage_records_lock held.
+def fold_traced_peak():
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    for stage_memory in traced_stages.values():
+        stage_memory[1] = max(stage_memory[1], traced_peak)
+    tracemalloc.reset_peak()
+
+
+# Starts tracking the memory of a stage call, None when tracemalloc is off
+def traced_stage_start():
+    if not tracemalloc.is_tracing():
+        return None
+    with stage_records_lock:
+        fold_traced_peak()
+        stage_id = next(traced_stage_ids)
+        traced_memory = tracemalloc.get_traced_memory()[0]
+        traced_stages[stage_id] = [traced_memory, traced_memory]
+    return stage_id
+
+
+# Peak memory allocated during a stage call in MB, above what was allocated when it started
+def traced_stage_peak_mb(stage_id):
+    if stage_id is None or not tracemalloc.is_tracing():
+        return None
+    with stage_records_lock:
+        fold_traced_peak()
+        [start_memory, peak_memory] = traced_stages.pop(stage_id)
+    return round((peak_memory - start_memory) / (1024 * 1024), 1)
+
+
+# Rows handled by a stage - length of its first dataframe argument, else of the dataframe it returned.
+# None for stages that do not handle data rows (email, uploads)
+def stage_rows(args, result):
+    candidates = list(args) + [result[0] if isinstance(result, (tuple, list)) and result else result]
+    for candidate in candidates:
+        if isinstance(candidate, pd.DataFrame):
+            return len(candidate)
+    return None
+
+
+# Adds a stage record, tagged with the branch the current thread is working on
+def record_stage(stage_name, seconds, rows, stage_peak_mb=None):
+    record = {"stage": stage_name, "branch": getattr(stage_context, "branch_code", None),
+              "seconds": round(seconds, 4), "rows": rows, "stage_peak_mb": stage_peak_mb,
+              "process_peak_rss_mb": process_peak_rss_mb(), "process": os.getpid()}
+    with stage_records_lock:
+        stage_records.append(record)
+    render_records = getattr(stage_context, "records", None)
+    if render_records is not None:
+        render_records.append(record)
+
+
+# Decorator - records wall time, rows processed and peak memory of every call to a pipeline stage
+# The stage's own peak memory is measured only while tracemalloc is on (--profile)
+def timed_stage(stage_name):
+    def decorator(stage_function):
+        @functools.wraps(stage_function)
+        def timed_function(*args, **kwargs):
+            stage_id = traced_stage_start()
+            stage_start = time.perf_counter()
+            result = None
+            try:
+                result = stage_function(*args, **kwargs)
+                return result
+            finally:
+                record_stage(stage_name, time.perf_counter() - stage_start, stage_rows(args, result),
+                             traced_stage_peak_mb(stage_id))
+        return timed_function
+    return decorator
+
+
+# Stage records of the block are tagged with the branch code
+@contextlib.contextmanager
+def branch_stage_context(branch_code, records=None):
+    stage_context.branch_code = branch_code
+    stage_context.records = records
+    try:
+        yield records
+    finally:
+        stage_context.branch_code = None
+        stage_context.records = None
+
+
+# Writes the stage records of this run as CSV and as JSON with per stage totals to the output folder
+def save_run_report(folder_name):
+    try:
+        if not stage_records:
+            return None
+        stages_df = pd.DataFrame(stage_records)
+        stages_df[["branch", "rows"]] = stages_df[["branch", "rows"]].astype("Int64")  # Empty for run wide stages
+        stage_totals = stages_df.groupby("stage", sort=False).agg(
+            calls=("seconds", "size"), total_seconds=("seconds", "sum"), max_seconds=("seconds", "max"),
+            rows=("rows", lambda rows: rows.sum(min_count=1)), stage_peak_mb=("stage_peak_mb", "max"),
+            process_peak_rss_mb=("process_peak_rss_mb", "max")).round(4)
+        if not os.path.exists(folder_name):
+            os.makedirs(folder_name)
+        save_as_csv(os.path.join(folder_name, "Run stages.csv"), stages_df.set_index("stage"))
+        with open(os.path.join(folder_name, "Run stages.json"), "w") as report_file:
+            json.dump({"created": str(dt.datetime.now()),
+                       "totals": json.loads(stage_totals.reset_index().to_json(orient="records")),
+                       "stages": json.loads(stages_df.to_json(orient="records"))}, report_file, indent=2)
+        print(stage_totals.to_string())
+        return stage_totals
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Saving run report",
+            "save_run_report"))
+
+
+# Saves cProfile statistics as .prof (for pstats/snakeviz) and the top functions by cumulative time as text
+def save_profile(profiler, folder_name):
+    try:
+        import pstats
+        if not os.path.exists(folder_name):
+            os.makedirs(folder_name)
+        profiler.dump_stats(os.path.join(folder_name, "Run profile.prof"))
+        with open(os.path.join(folder_name, "Run profile.txt"), "w") as profile_file:
+            pstats.Stats(profiler, stream=profile_file).sort_stats("cumulative").print_stats(50)
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Saving profile",
+            "save_profile"))
+
+
 # Connects to Gmail using oath2.0
 def connect_to_gmail(email_login_dict):
     try:
+        import yagmail
         yag_connection = yagmail.SMTP(user=email_login_dict[username_key],
-                                      oauth2_file=os.path.join(os.getcwd(),
-                                                               email_details["Oauth_2.0_file"]))  # client_secret_local
+                                      oauth2_file=oauth2_file_path)  # client_secret_local
         return yag_connection
     except:
         logging.error(log_template % (
@@ -164,67 +473,360 @@ def connect_to_gmail(email_login_dict):
             "connect_to_gmail"))
 
 
+# Connects to a local SMTP server without TLS or login - used as an offline stand-in for Gmail
+def connect_to_local_smtp(email_login_dict, port):
+    try:
+        import yagmail
+        yag_connection = yagmail.SMTP(user=email_login_dict[username_key], host="localhost", port=port,
+                                      smtp_ssl=False, smtp_starttls=False, smtp_skip_login=True)
+        return yag_connection
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Connecting to local SMTP server",
+            "connect_to_local_smtp"))
+
+
+# Minimal SMTP sink - accepts and counts every message, nothing is delivered
+class LocalSMTPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write(b"220 localhost stand-in SMTP\r\n")
+        in_data = False
+        for line in self.rfile:
+            if in_data:
+                if line.rstrip(b"\r\n") == b".":
+                    in_data = False
+                    with self.server.lock:
+                        self.server.messages_received += 1
+                    self.wfile.write(b"250 OK\r\n")
+                continue
+            command = line[:4].upper()
+            if command == b"DATA":
+                in_data = True
+                self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+            elif command == b"QUIT":
+                self.wfile.write(b"221 Bye\r\n")
+                break
+            else:
+                self.wfile.write(b"250 OK\r\n")
+
+
+# Starts the stand-in SMTP server on a background thread. Port 0 picks a free port.
+# Output - server (stop with server.shutdown()) and the port it listens on
+def start_local_smtp_server(port=0):
+    server = socketserver.ThreadingTCPServer(("localhost", port), LocalSMTPHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.messages_received = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+
+# Authenticated SMTP sessions shared by all branch emails of a run
+smtp_session_pool = queue.Queue()
+smtp_sessions = []
+
+
+# Checks the pooled connection is still open
+def smtp_session_alive(yag_connection):
+    try:
+        return yag_connection.smtp is not None and yag_connection.smtp.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+        return False
+
+
+# Opens a fixed number of SMTP sessions, each logged in once and reused until the pool is closed.
+# If local_smtp_port is set, sessions connect to a local stand-in server instead of Gmail.
+def open_smtp_pool(email_login_dict, pool_size=1, local_smtp_port=None):
+    try:
+        for _ in range(pool_size):
+            if local_smtp_port is None:
+                yag_connection = connect_to_gmail(email_login_dict)
+            else:
+                yag_connection = connect_to_local_smtp(email_login_dict, local_smtp_port)
+            if not smtp_session_alive(yag_connection):
+                yag_connection.login()
+            smtp_sessions.append(yag_connection)
+            smtp_session_pool.put(yag_connection)
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Opening SMTP session pool",
+            "open_smtp_pool"))
+
+
+# Closes all pooled SMTP sessions - called once at the end of the run
+def close_smtp_pool():
+    while smtp_sessions:
+        smtp_sessions.pop().close()
+    while not smtp_session_pool.empty():
+        smtp_session_pool.get_nowait()
+
+
+# Sends email over a pooled session, reconnecting once if the server dropped the connection
+def send_email_pooled(branch_email, email_title, email_content, attachments_list):
+    yag_connection = smtp_session_pool.get()
+    try:
+        recipients, msg_strings = yag_connection.prepare_send(to=branch_email, subject=email_title,
+                                                              contents=email_content, attachments=attachments_list)
+        for attempt in range(2):
+            try:
+                if not smtp_session_alive(yag_connection):
+                    yag_connection.login()
+                yag_connection.smtp.sendmail(yag_connection.user, recipients, msg_strings)
+                return True
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                yag_connection.smtp = None
+                if attempt == 1:
+                    raise
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Sending Email",
+            "send_email_pooled"))
+        return False
+    finally:
+        smtp_session_pool.put(yag_connection)
+
+
 # Generates and sends email including all attachments created
+# Uses the pooled SMTP sessions when open, otherwise a connection per email
+@timed_stage("send_email")
 def send_email(branch_email, email_title, email_content, attachments_list):
+    attachments_list = [artifact_source(entry) for entry in attachments_list]
+    if smtp_sessions:
+        return send_email_pooled(branch_email, email_title, email_content, attachments_list)
     yag_connection = connect_to_gmail(email_details)
-    attachments_list = [os.path.join(os.getcwd(), entry) for entry in attachments_list]
     try:
         yag_connection.send(to=branch_email, subject=email_title, contents=email_content,
                             attachments=attachments_list)
         yag_connection.close()
+        return True
     except:
         logging.error(log_template % (
             str(dt.datetime.now()), "Sending Email",
             "send_email"))
+        return False
+
+
+# S3 client shared by all uploads of this process (boto3 clients are thread safe)
+s3_client = None
+s3_client_lock = threading.Lock()
+
+
+# Creates the S3 client once per process and reuses it.
+# Optional endpoint_url in s3_login points at a local S3 stand-in (moto server, minio)
+def get_s3_client(s3_login_dict):
+    global s3_client
+    with s3_client_lock:
+        if s3_client is None:
+            import boto3
+            session = boto3.Session(
+                aws_access_key_id=s3_login_dict['aws_access_key_id'],
+                aws_secret_access_key=s3_login_dict['aws_secret_access_key'],
+                region_name=s3_login_dict['region_name']
+            )
+            s3_client = session.client(s3_login_dict['service_name'], endpoint_url=s3_login_dict.get('endpoint_url'))
+        return s3_client
+
+
+# Multipart and concurrency settings from the optional "transfer" block of s3_login
+# Sizes are in MB, upload_workers is the number of files uploaded at once
+def s3_transfer_settings(s3_login_dict):
+    import boto3.s3.transfer
+    transfer_details = s3_login_dict.get("transfer", {})
+    megabyte = 1024 * 1024
+    transfer_config = boto3.s3.transfer.TransferConfig(
+        multipart_threshold=int(transfer_details.get("multipart_threshold_mb", 8) * megabyte),
+        multipart_chunksize=int(transfer_details.get("multipart_chunksize_mb", 8) * megabyte),
+        max_concurrency=transfer_details.get("max_concurrency", 10),
+        use_threads=True)
+    return transfer_config, transfer_details.get("upload_workers", 4), transfer_details.get("skip_existing", False)
+
+
+# True if the bucket already holds the key with the same content.
+# The ETag of a single part upload is the MD5 of the content, multipart uploads are compared by size only.
+def s3_object_matches(client, bucket_name, key, single_file):
+    try:
+        object_head = client.head_object(Bucket=bucket_name, Key=key)
+    except:
+        return False  # Missing object (or no access) - upload it
+    if object_head["ContentLength"] != artifact_size(single_file):
+        return False
+    etag = object_head["ETag"].strip('"')
+    return "-" in etag or etag == artifact_content_hash(single_file, "md5")
 
 
-# Transfer file to S3 AWS as archive
-def transfer_to_aws(file_list, s3_login_dict):
+# Uploads a single file under a date prefixed key. In-memory artifacts are streamed from their buffer
+# skip_existing leaves files that are already in the bucket with the same content
+def upload_file_to_s3(client, single_file, s3_login_dict, transfer_config, skip_existing=False):
     try:
-        session = boto3.Session(
-            aws_access_key_id=s3_login_dict['aws_access_key_id'],
-            aws_secret_access_key=s3_login_dict['aws_secret_access_key'],
-            region_name=s3_login_dict['region_name']
-        )
+        timestamped_filename = str(dt.datetime.now().date()) + " " + artifact_name(single_file)
+        if skip_existing and s3_object_matches(client, s3_login_dict['bucket_name'], timestamped_filename,
+                                               single_file):
+            return True
+        if isinstance(single_file, tuple):
+            client.upload_fileobj(artifact_source(single_file), s3_login_dict['bucket_name'], timestamped_filename,
+                                  Config=transfer_config)
+        else:
+            client.upload_file(single_file, s3_login_dict['bucket_name'], timestamped_filename,
+                               Config=transfer_config)
+        return True
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Uploading to s3",
+            "upload_file_to_s3") + ". Failed on file " + artifact_name(single_file))
+        return False
+
+
+# Uploads files to S3 concurrently
+# Output - list of files that failed to upload
+def upload_files_to_s3(file_list, s3_login_dict):
+    try:
+        client = get_s3_client(s3_login_dict)
     except:
         logging.error(log_template % (
             str(dt.datetime.now()), "Connecting to s3",
-            "transfer_to_aws"))
+            "upload_files_to_s3"))
+        return list(file_list)
 
-    for single_file in file_list:
-        try:
-            timestamped_filename = str(dt.datetime.now().date()) + " " + single_file
-            s3_resource = session.resource(s3_login_dict['service_name']).Bucket(s3_login_dict['bucket_name'])
-            s3_resource.upload_file(single_file, timestamped_filename)
-        except:
-            logging.error(log_template % (
-                str(dt.datetime.now()), "Uploading to s3",
-                "transfer_to_aws") + ". Failed on file " + str(single_file))
+    [transfer_config, upload_workers, skip_existing] = s3_transfer_settings(s3_login_dict)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(upload_workers, 1)) as executor:
+        uploaded = list(executor.map(lambda single_file: upload_file_to_s3(client, single_file, s3_login_dict,
+                                                                           transfer_config, skip_existing),
+                                     file_list))
+    return [single_file for single_file, file_uploaded in zip(file_list, uploaded) if not file_uploaded]
+
+
+# Transfer file to S3 AWS as archive
+@timed_stage("transfer_to_aws")
+def transfer_to_aws(file_list, s3_login_dict):
+    failed_files = upload_files_to_s3(file_list, s3_login_dict)
+    return not failed_files
 
     # Print all file names in bucket
-    # for file in s3_resource.objects.all():
-    #     print(file.key)
+    # for file in get_s3_client(s3_login_dict).list_objects_v2(Bucket=s3_login_dict['bucket_name'])["Contents"]:
+    #     print(file["Key"])
+
+
+# Prefix of the run archive and retention age in days (None keeps everything) from the optional "archive" block
+def s3_archive_settings(s3_login_dict):
+    archive_details = s3_login_dict.get("archive", {})
+    return archive_details.get("prefix", "archive").strip("/"), archive_details.get("retention_days")
+
+
+# Uploads the run archive files under <prefix>/run=<date>/
+@timed_stage("upload_run_archive")
+def upload_run_archive(archive_artifacts, s3_login_dict, run_date):
+    try:
+        client = get_s3_client(s3_login_dict)
+        [transfer_config, _, _] = s3_transfer_settings(s3_login_dict)
+        [archive_prefix, _] = s3_archive_settings(s3_login_dict)
+        for artifact in archive_artifacts:
+            client.upload_fileobj(artifact_source(artifact), s3_login_dict['bucket_name'],
+                                  "%s/run=%s/%s" % (archive_prefix, run_date, artifact_name(artifact)),
+                                  Config=transfer_config)
+        return True
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Uploading run archive",
+            "upload_run_archive"))
+        return False
+
+
+# Retention policy - deletes archived runs and date prefixed backup files older than retention_days
+# Output - number of deleted objects
+@timed_stage("expire_s3_backups")
+def expire_s3_backups(s3_login_dict, today=None):
+    [archive_prefix, retention_days] = s3_archive_settings(s3_login_dict)
+    if retention_days is None:
+        return 0
+    try:
+        client = get_s3_client(s3_login_dict)
+        oldest_kept = str((today or dt.date.today()) - dt.timedelta(days=retention_days))
+        # Only the keys written here - "2020-08-30 Branch report for X.csv" backups and "archive/run=2020-08-30/" runs
+        backup_key = re.compile(r"^(?:(\d{4}-\d{2}-\d{2}) |%s/run=(\d{4}-\d{2}-\d{2})/)" % re.escape(archive_prefix))
+        expired_keys = []
+        for page in client.get_paginator("list_objects_v2").paginate(Bucket=s3_login_dict['bucket_name']):
+            for s3_object in page.get("Contents", []):
+                key_date = backup_key.match(s3_object["Key"])
+                if key_date and (key_date.group(1) or key_date.group(2)) < oldest_kept:
+                    expired_keys.append(s3_object["Key"])
+        for batch_start in range(0, len(expired_keys), 1000):  # delete_objects takes at most 1000 keys
+            client.delete_objects(Bucket=s3_login_dict['bucket_name'], Delete={
+                "Objects": [{"Key": key} for key in expired_keys[batch_start:batch_start + 1000]], "Quiet": True})
+        return len(expired_keys)
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Deleting expired backups",
+            "expire_s3_backups"))
+        return 0
+
+
+# Connection pool shared by all queries of this process
+db_connection_pool = None
+db_connection_pool_lock = threading.Lock()
+
+
+# Creates the connection pool once per process. Pool size is PoolSize in db_login (default 4, at most 32)
+def get_database_pool(sql_details):
+    global db_connection_pool
+    with db_connection_pool_lock:
+        if db_connection_pool is None:
+            import mysql.connector.pooling  # Install mysql-connector-python
+            pool_size = min(int(sql_details.get(pool_size_key, 4)), mysql.connector.pooling.CNX_POOL_MAXSIZE)
+            db_connection_pool = mysql.connector.pooling.MySQLConnectionPool(
+                pool_name="branch_manager_report",
+                pool_size=pool_size,
+                user=sql_details[username_key],
+                password=sql_details[password_key],
+                database=sql_details[database_key],
+                host=sql_details[host_key],
+                port=sql_details[port_key]
+            )
+        return db_connection_pool
 
 
 # creates connection to sql database
-def connect_to_database(sql_details):
-    try:
-        cnx = mysql.connector.connect(
-            user=sql_details[username_key],
-            password=sql_details[password_key],
-            database=sql_details[database_key],
-            host=sql_details[host_key],
-            port=sql_details[port_key]
-        )
+# Connections are checked out of the pool (waiting up to timeout seconds when all are in use)
+# and pinged before use, reconnecting if the server dropped them. close() returns them to the pool.
+def connect_to_database(sql_details, timeout=60):
+    try:
+        import mysql.connector
+        pool = get_database_pool(sql_details)
+        wait_until = time.monotonic() + timeout
+        while True:
+            try:
+                cnx = pool.get_connection()
+                break
+            except mysql.connector.errors.PoolError:
+                if time.monotonic() > wait_until:
+                    raise
+                time.sleep(0.05)
+        cnx.ping(reconnect=True, attempts=3, delay=1)  # Health check
         return cnx
     except:
-        str(logging.error(log_template % (dt.datetime.now()), "Connection to SQL database", "connect_to_database", ))
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Connection to SQL database", "connect_to_database"))
+
+
+# Context managed checkout - the connection goes back to the pool when the block ends
+@contextlib.contextmanager
+def database_connection(sql_details):
+    connection = connect_to_database(sql_details)
+    try:
+        yield connection
+    finally:
+        if connection is not None:
+            connection.close()
 
 
 # Creates SQL query
-def branch_manager_report_query(date_four_months_ago, date_now, fields_dict):
+# Dates are bound as parameters, so the statement text is the same every run
+# Output - query text with %(name)s placeholders, parameters dictionary and fields dictionary
+# membership_filter=False keeps lessons of users in any branch - the weekly cache applies
+# the branch filters when it joins current membership from report_users_query
+def branch_manager_report_query(date_four_months_ago, date_now, fields_dict, membership_filter=True):
     # Dates needs to be strings in format 2016-08-07
     try:
+        query_params = {"date_begin": str(date_four_months_ago), "date_end": str(date_now)}
         final_columns = '''
             userID, 
             firstname_eng, 
@@ -258,6 +860,12 @@ def branch_manager_report_query(date_four_months_ago, date_now, fields_dict):
             lesson_id_connect
             '''
         lesson_followup_table = "shecodes_monster_2_0.lessons_followup"
+        # Date range on the raw TIMESTAMP column so an index on it can be used.
+        # Covers whole days from date_four_months_ago up to and including date_now.
+        timestamp_range_clause = (
+            "TIMESTAMP >= UNIX_TIMESTAMP(%(date_begin)s) AND "
+            "TIMESTAMP < UNIX_TIMESTAMP(DATE_ADD(%(date_end)s, INTERVAL 1 DAY))"
+        )
         new_users_columns = '''
             userid_connect AS userID,
             firstname_eng,
@@ -268,19 +876,6 @@ def branch_manager_report_query(date_four_months_ago, date_now, fields_dict):
             '''
         new_users_table = "shecodes_monster_2_0.users_new"
         lesson_mapping_table = "shecodes_monster_2_0.lessons_mapping"
-        branch_type_select = '''
-            id AS branch_ID,
-            short_name AS branchName,
-            branchTypeID,
-            branchTypes AS branchType,
-            active
-            '''
-        branch_type_columns = '''
-            id AS branchTypeID,
-            branch_type AS branchTypes
-            '''
-        branch_type_table = "shecodes_monster_2_0.branch_types"
-        branch_table = "shecodes_monster_2_0.branch"
         track_name_columns = '''
             ID,
             track_name AS track
@@ -293,31 +888,17 @@ def branch_manager_report_query(date_four_months_ago, date_now, fields_dict):
             track_id_connect NOT IN(14) AND
             active IS NOT NULL AND
             serial_number IS NOT NULL
+            ''' if membership_filter else '''
+            track_category NOT IN(0, 8) AND
+            track_type NOT IN(0, 3) AND
+            track_id_connect NOT IN(14) AND
+            serial_number IS NOT NULL
             '''
         order_clause = "lessonNo"
         group_clause = '''
             userID,
             lessondate
             '''
-        user_max_type_no_assignment_date_select = '''
-            user_ID, maxRoleID AS role_ID, shortname AS roleName
-            '''
-        user_max_type_select = '''
-            user_ID, MAX(replaced_role_ids) as maxRoleID, assignRoleDate
-            '''
-        user_type_select = '''
-            userid as user_ID , 
-            FROM_UNIXTIME(timemodified, '%Y-%m-%d') AS assignRoleDate
-            ''' + ","
-        cases_clause = ''' 
-        WHEN roleid = 28 THEN 0 
-        WHEN roleid = 25 THEN 0 
-        WHEN roleid = 24 THEN 0 
-        ELSE roleid 
-        '''
-        roles_table = "shecodes_shecodes.mdl_role_assignments"
-        group_clause2 = 'user_ID'
-        where_clause2 = "user_ID IS NOT NULL"
 
         query_text = (
             f'SELECT {final_columns} '
@@ -326,6 +907,7 @@ def branch_manager_report_query(date_four_months_ago, date_now, fields_dict):
             f'FROM(SELECT {all_columns} '
             f'FROM(SELECT {lesson_followup_columns} '
             f'FROM {lesson_followup_table} '
+            f'WHERE {timestamp_range_clause} '
             f') AS lessonDateTable '
             f'LEFT JOIN (SELECT {new_users_columns} '
             f'FROM {new_users_table} '
@@ -333,13 +915,7 @@ def branch_manager_report_query(date_four_months_ago, date_now, fields_dict):
             f'ON userid_connect = userID '
             f'LEFT JOIN {lesson_mapping_table} '
             f'ON lessons_mapping.lesson_id_connect = lessonDateTable.lesson_id_connect '
-            f'LEFT JOIN (SELECT {branch_type_select} '
-            f'FROM(SELECT {branch_type_columns} '
-            f'FROM {branch_type_table} '
-            f') AS Branch_Types  '
-            f'RIGHT JOIN {branch_table} '
-            f'ON branch.branch_type = Branch_Types.branchTypeID '
-            f') AS Branches '
+            f'LEFT JOIN {branches_subquery()}'
             f'ON branch_ID = BranchID '
             f'LEFT JOIN shecodes_monster_2_0.tracks '
             f'ON tracks.track_id_connect = lessonDateTable.trackID '
@@ -347,45 +923,387 @@ def branch_manager_report_query(date_four_months_ago, date_now, fields_dict):
             f'FROM {track_name_table} '
             f') AS '
             f'track ON track.ID = tracks.track_name '
-            f'WHERE {where_clause} AND '
-            f"UNIX_TIMESTAMP(lessonDate) BETWEEN UNIX_TIMESTAMP(\'{date_four_months_ago}\') AND UNIX_TIMESTAMP(\'{date_now}\') "
+            f'WHERE {where_clause} '
             f'ORDER BY {order_clause} DESC '
             f') AS t '
             f'GROUP BY {group_clause} '
             f')AS t3 '
             f')AS user_lessons_branch_table '
-            f'LEFT JOIN (SELECT {user_max_type_no_assignment_date_select} '
-            f'FROM (SELECT * '
-            f'FROM (SELECT {user_max_type_select} '
-            f'FROM (SELECT {user_type_select} '
-            f'CASE {cases_clause} '
-            f'END AS replaced_role_ids '
-            f'FROM {roles_table} '
-            f') AS userRoleSubset '
-            f'GROUP BY {group_clause2} '
-            f') AS data_table '
-            f'LEFT JOIN mdl_role '
-            f'ON data_table.maxRoleID=mdl_role.id '
-            f'WHERE {where_clause2} '
-            f') AS role_table '
-            f') AS highest_roles '
+            f'LEFT JOIN {highest_roles_subquery(lesson_followup_table, timestamp_range_clause)}'
             f'ON user_lessons_branch_table.userID=highest_roles.user_ID '
         )
-        return query_text, fields_dict
+        return query_text, query_params, fields_dict
     except:
         logging.error(log_template % (
             str(dt.datetime.now()), "SQL query composition failed", "branch_manager_report_query"))
 
 
-# Retrieve data from sql database using a pre generated query
-def query_database(connection, query):
+# Branch id, name, type and active flag of every branch
+def branches_subquery():
+    branch_type_select = '''
+            id AS branch_ID,
+            short_name AS branchName,
+            branchTypeID,
+            branchTypes AS branchType,
+            active
+            '''
+    branch_type_columns = '''
+            id AS branchTypeID,
+            branch_type AS branchTypes
+            '''
+    branch_type_table = "shecodes_monster_2_0.branch_types"
+    branch_table = "shecodes_monster_2_0.branch"
+    return (
+        f'(SELECT {branch_type_select} '
+        f'FROM(SELECT {branch_type_columns} '
+        f'FROM {branch_type_table} '
+        f') AS Branch_Types  '
+        f'RIGHT JOIN {branch_table} '
+        f'ON branch.branch_type = Branch_Types.branchTypeID '
+        f') AS Branches '
+    )
+
+
+# Highest role of each user with lessons in the date range
+def highest_roles_subquery(lesson_followup_table, timestamp_range_clause):
+    user_max_type_no_assignment_date_select = '''
+            user_ID, maxRoleID AS role_ID, shortname AS roleName
+            '''
+    user_max_type_select = '''
+            user_ID, MAX(replaced_role_ids) as maxRoleID, assignRoleDate
+            '''
+    user_type_select = '''
+            userid as user_ID , 
+            FROM_UNIXTIME(timemodified, '%Y-%m-%d') AS assignRoleDate
+            ''' + ","
+    cases_clause = ''' 
+        WHEN roleid = 28 THEN 0 
+        WHEN roleid = 25 THEN 0 
+        WHEN roleid = 24 THEN 0 
+        ELSE roleid 
+        '''
+    roles_table = "shecodes_shecodes.mdl_role_assignments"
+    group_clause2 = 'user_ID'
+    where_clause2 = "user_ID IS NOT NULL"
+    return (
+        f'(SELECT {user_max_type_no_assignment_date_select} '
+        f'FROM (SELECT * '
+        f'FROM (SELECT {user_max_type_select} '
+        f'FROM (SELECT {user_type_select} '
+        f'CASE {cases_clause} '
+        f'END AS replaced_role_ids '
+        f'FROM {roles_table} '
+        f'WHERE userid IN (SELECT userid_connect FROM {lesson_followup_table} WHERE {timestamp_range_clause}) '
+        f') AS userRoleSubset '
+        f'GROUP BY {group_clause2} '
+        f') AS data_table '
+        f'LEFT JOIN mdl_role '
+        f'ON data_table.maxRoleID=mdl_role.id '
+        f'WHERE {where_clause2} '
+        f') AS role_table '
+        f') AS highest_roles '
+    )
+
+
+# Current details, branch and highest role of every user with lessons in the date range, one row per user.
+# Same branch filters as the report query. The weekly cache joins it to cached lessons on every run,
+# so branch membership is always as of the time the data is pulled.
+def report_users_query(date_begin, date_end):
+    try:
+        query_params = {"date_begin": str(date_begin), "date_end": str(date_end)}
+        lesson_followup_table = "shecodes_monster_2_0.lessons_followup"
+        timestamp_range_clause = (
+            "TIMESTAMP >= UNIX_TIMESTAMP(%(date_begin)s) AND "
+            "TIMESTAMP < UNIX_TIMESTAMP(DATE_ADD(%(date_end)s, INTERVAL 1 DAY))"
+        )
+        users_columns = '''
+            userid_connect AS userID,
+            firstname_eng,
+            lastname_eng,
+            email,
+            FROM_UNIXTIME(date_joined_lms, '%Y-%m-%d') AS dateJoined,
+            users_new.branch_ID AS branchID,
+            branchName,
+            role_ID,
+            roleName
+            '''
+        where_clause = '''
+            userid_connect IN (SELECT userid_connect FROM {0} WHERE {1}) AND
+            branchTypeID NOT IN(1, 9) AND
+            active IS NOT NULL
+            '''.format(lesson_followup_table, timestamp_range_clause)
+        query_text = (
+            f'SELECT {users_columns} '
+            f'FROM shecodes_monster_2_0.users_new '
+            f'LEFT JOIN {branches_subquery()}'
+            f'ON Branches.branch_ID = users_new.branch_ID '
+            f'LEFT JOIN {highest_roles_subquery(lesson_followup_table, timestamp_range_clause)}'
+            f'ON users_new.userid_connect=highest_roles.user_ID '
+            f'WHERE {where_clause} '
+        )
+        return query_text, query_params
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "SQL query composition failed", "report_users_query"))
+
+
+# Week ordinal of lessonDate counted from the first Sunday of the report (negative before it)
+week_bucket_sql = "FLOOR(DATEDIFF(lessonDate, %(first_week_start)s) / 7)"
+
+
+# Aggregated query mode - distinct active users per branch, track and week computed in MySQL.
+# Runs on top of the row level query so both modes count exactly the same rows.
+# WITH ROLLUP adds the branch and week subtotal, which is the branch total. GROUPING(track) tells it
+# apart from a group of rows whose track really is NULL.
+def branch_week_counts_query(date_begin, date_end, first_week_start, fields_dict):
+    try:
+        row_level_query, query_params, fields_dict = branch_manager_report_query(date_begin, date_end, fields_dict)
+        query_params["first_week_start"] = first_week_start
+        query_text = (
+            f'SELECT branchID, {week_bucket_sql} AS weekIndex, track, '
+            f'COUNT(DISTINCT userID) AS activeUsers, GROUPING(track) AS trackSubtotal '
+            f'FROM ({row_level_query}) AS activity '
+            f'GROUP BY branchID, weekIndex, track WITH ROLLUP '
+            f'HAVING branchID IS NOT NULL AND weekIndex IS NOT NULL '
+        )
+        return query_text, query_params, fields_dict
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "SQL query composition failed", "branch_week_counts_query"))
+
+
+# Aggregated query mode - highest lesson per user, track and week computed in MySQL
+# User details are constant per user, MAX keeps the query valid under ONLY_FULL_GROUP_BY
+def user_week_progress_query(date_begin, date_end, first_week_start, fields_dict):
+    try:
+        row_level_query, query_params, fields_dict = branch_manager_report_query(date_begin, date_end, fields_dict)
+        query_params["first_week_start"] = first_week_start
+        user_columns = '''
+            userID,
+            MAX(firstname_eng) AS firstname_eng,
+            MAX(lastname_eng) AS lastname_eng,
+            MAX(email) AS email,
+            MAX(dateJoined) AS dateJoined,
+            track,
+            weekIndex,
+            MAX(lessonNo) AS lessonNo,
+            MAX(branchID) AS branchID,
+            MAX(branchName) AS branchName,
+            MAX(role_ID) AS role_ID,
+            MAX(roleName) AS roleName
+            '''
+        query_text = (
+            f'SELECT {user_columns} '
+            f'FROM (SELECT *, {week_bucket_sql} AS weekIndex '
+            f'FROM ({row_level_query}) AS activity '
+            f') AS weekly_activity '
+            f'GROUP BY userID, track, weekIndex '
+        )
+        return query_text, query_params, fields_dict
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "SQL query composition failed", "user_week_progress_query"))
+
+
+# Week index from SQL, weeks outside the report range become -1
+def clip_week_index(week_index, num_weeks):
+    week_index = week_index.astype(int)
+    return week_index.where((week_index >= 0) & (week_index < num_weeks), -1)
+
+
+# Converts the aggregated counts query result to the precomputed counts used by the branch reports
+# (same layout as branch_activity_counts)
+def branch_counts_from_aggregate(counts_df, fields_dict, track_col, week_start_list, week_end_list):
+    try:
+        branch_col = fields_dict["branch_id"]
+        weeks = range(len(week_start_list))
+        counts_df[week_index_col] = clip_week_index(counts_df["weekIndex"], len(week_start_list))
+        counts_df["activeUsers"] = counts_df["activeUsers"].astype(int)
+        is_total = counts_df["trackSubtotal"].astype(int) == 1  # ROLLUP subtotal, not a NULL track group
+
+        totals = counts_df.loc[is_total].groupby([branch_col, week_index_col])["activeUsers"].sum().unstack(
+            fill_value=0)
+        totals = totals.reindex(columns=weeks, fill_value=0)
+        totals.columns = week_range_names(week_start_list, week_end_list)
+
+        # Groups with a NULL track count in the total only, as in the row level mode
+        by_track = counts_df.loc[~is_total].groupby([branch_col, track_col, week_index_col])["activeUsers"].sum()
+        by_track = by_track.unstack(fill_value=0).reindex(columns=weeks, fill_value=0)
+        by_track.columns = week_range_names(week_start_list, week_end_list)
+        return totals, by_track
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Converting aggregated counts", "branch_counts_from_aggregate"))
+
+
+# Streams query results from the database in batches of chunk_size rows
+# The query runs as a prepared statement on an unbuffered cursor, rows are read from the server batch by batch
+# With fields_dict, each batch is cast to the compact activity types before it is passed on
+# Output - generator of dataframes, one per batch
+def query_database_chunks(connection, query, chunk_size, query_params=None, fields_dict=None):
+    cursor = connection.cursor(prepared=True)
+    try:
+        cursor.execute(*prepared_statement(query, query_params))
+        columns = list(cursor.column_names)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunk_df = pd.DataFrame.from_records(rows, columns=columns)
+            yield compact_activity_types(chunk_df, fields_dict) if fields_dict else chunk_df
+    finally:
+        cursor.close()
+
+
+# Concatenates batches of compact typed rows. Each batch has its own categories, so they are unified first -
+# otherwise pandas falls back to object columns
+def concat_typed_chunks(chunks):
+    from pandas.api.types import union_categoricals
+    category_cols = [col for col in chunks[0].columns if isinstance(chunks[0][col].dtype, pd.CategoricalDtype)]
+    for col in category_cols:
+        categories = union_categoricals([chunk[col] for chunk in chunks], sort_categories=True).categories
+        for chunk in chunks:
+            chunk[col] = chunk[col].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+
+# Writes a batch of rows to the partition folder of each branch in it, as one Parquet file per batch.
+# Parquet keeps the compact types, and names such as "NA" or "None" are not read back as missing values.
+# The folder of a branch is emptied when the branch first appears, so files of earlier runs are not mixed in.
+def append_branch_partitions(chunk_df, branch_col, partition_folder, partition_files, chunk_no):
+    for branch_code, branch_chunk in chunk_df.groupby(branch_col, observed=True):
+        if branch_code not in partition_files:
+            partition_files[branch_code] = os.path.join(partition_folder, "branch_%s" % branch_code)
+            os.makedirs(partition_files[branch_code], exist_ok=True)
+            for part_file in branch_partition_parts(partition_files[branch_code]):
+                os.remove(part_file)
+        branch_chunk.to_parquet(os.path.join(partition_files[branch_code], "part_%06d.parquet" % chunk_no),
+                                index=False)
+    return partition_files
+
+
+# Streams query results into one partition folder per branch, batch by batch,
+# so memory use is bounded by chunk_size and not by the size of the date range
+# Output - dictionary of branch code to partition folder
+def query_database_to_branch_partitions(connection, query, chunk_size, branch_col, partition_folder,
+                                        query_params=None, fields_dict=None):
+    try:
+        if not os.path.exists(partition_folder):
+            os.makedirs(partition_folder)
+        partition_files = {}
+        chunks = query_database_chunks(connection, query, chunk_size, query_params, fields_dict)
+        for chunk_no, chunk_df in enumerate(chunks):
+            partition_files = append_branch_partitions(chunk_df, branch_col, partition_folder, partition_files,
+                                                       chunk_no)
+        return partition_files
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Streaming query into branch partitions failed",
+            "query_database_to_branch_partitions"))
+
+
+# Parquet files of a branch partition folder, in the order they were written
+def branch_partition_parts(partition_file):
+    return [os.path.join(partition_file, file_name) for file_name in sorted(os.listdir(partition_file))
+            if file_name.endswith(".parquet")]
+
+
+# Loads a single branch partition written by query_database_to_branch_partitions
+def load_branch_partition(partition_file):
+    try:
+        return concat_typed_chunks([pd.read_parquet(part_file) for part_file in branch_partition_parts(partition_file)])
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Loading branch partition " + str(partition_file),
+            "load_branch_partition"))
+
+
+# Indexes the branch report query relies on - table, index name and columns
+query_index_advisory = [
+    ("shecodes_monster_2_0.lessons_followup", "idx_lessons_followup_timestamp", "TIMESTAMP, userid_connect"),
+    ("shecodes_monster_2_0.users_new", "idx_users_new_userid_connect", "userid_connect"),
+    ("shecodes_monster_2_0.lessons_mapping", "idx_lessons_mapping_lesson_id", "lesson_id_connect"),
+    ("shecodes_monster_2_0.tracks", "idx_tracks_track_id_connect", "track_id_connect"),
+    ("shecodes_shecodes.mdl_role_assignments", "idx_role_assignments_userid", "userid"),
+]
+
+
+# Prints the EXPLAIN plan of a query and the indexes it needs, marking the ones missing in the database
+def explain_query(connection, query, query_params=None):
     try:
+        cursor = connection.cursor(prepared=True)
+        cursor.execute(*prepared_statement("EXPLAIN " + query, query_params))
+        plan_df = pd.DataFrame(cursor.fetchall(), columns=list(cursor.column_names))
+        cursor.close()
         cursor = connection.cursor()
-        cursor.execute(query)
+        print(plan_df.to_string())
+        print("\nIndexes used by the branch report query:")
+        for table_name, index_name, index_columns in query_index_advisory:
+            cursor.execute("SHOW INDEX FROM " + table_name)
+            index_df = pd.DataFrame(cursor.fetchall(), columns=list(cursor.column_names))
+            leading_columns = index_df.loc[index_df["Seq_in_index"] == 1, "Column_name"].str.lower().tolist()
+            first_column = index_columns.split(",")[0].strip().lower()
+            status = "exists" if first_column in leading_columns else "MISSING"
+            print("%-8s CREATE INDEX %s ON %s (%s);" % (status, index_name, table_name, index_columns))
+        cursor.close()
+        return plan_df
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Explaining query failed", "explain_query"))
+
+
+# Timing harness - executes the prepared report query repeatedly on one connection and prints
+# the range query latency. Point db_login in the config file at a local MySQL instance to benchmark.
+def time_range_query(date_begin, date_end, repeats=5):
+    try:
+        query_text, query_params, _ = branch_manager_report_query(str(date_begin), str(date_end),
+                                                                  query_fields_details)
+        with database_connection(sql_details) as connection:
+            [statement, statement_params] = prepared_statement(query_text, query_params)
+            cursor = connection.cursor(prepared=True)
+            latencies = []
+            for _ in range(repeats):
+                query_start = time.perf_counter()
+                cursor.execute(statement, statement_params)  # Same statement object - prepared once, executed again
+                row_count = len(cursor.fetchall())
+                latencies.append(time.perf_counter() - query_start)
+            cursor.close()
+        print("Range query %s - %s: %d rows, %d runs, min %.3fs, median %.3fs, max %.3fs" % (
+            date_begin, date_end, row_count, repeats, min(latencies), float(np.median(latencies)), max(latencies)))
+        return latencies
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Timing range query failed", "time_range_query"))
+
+
+# %(name)s parameters converted to ? placeholders once per query text, with the parameter names in order.
+# The prepared cursor only reuses a prepared statement when it is executed with the same text object again,
+# and converts dict parameters into a new text on every execute, so the conversion is done (and cached) here.
+@functools.lru_cache(maxsize=32)
+def positional_statement(query):
+    return re.sub(r"%\((\w+)\)s", "?", query), tuple(re.findall(r"%\((\w+)\)s", query))
+
+
+# Statement text and parameter tuple to execute a query with on a prepared cursor
+def prepared_statement(query, query_params=None):
+    if not isinstance(query_params, dict):
+        return query, query_params
+    [statement, param_names] = positional_statement(query)
+    return statement, tuple(query_params[param_name] for param_name in param_names)
+
+
+# Retrieve data from sql database using a pre generated query, executed as a prepared statement
+# If chunk_size is set rows are fetched in batches and converted to a dataframe batch by batch.
+# The batches are then combined, so peak memory is about twice the result - only partition mode is bounded by chunk_size
+def query_database(connection, query, chunk_size=None, query_params=None, fields_dict=None):
+    try:
+        if chunk_size:
+            chunks = list(query_database_chunks(connection, query, chunk_size, query_params, fields_dict))
+            return concat_typed_chunks(chunks) if fields_dict else pd.concat(chunks, ignore_index=True)
+        cursor = connection.cursor(prepared=True)
+        cursor.execute(*prepared_statement(query, query_params))
         columns = cursor.column_names
-        query_data_df = pd.DataFrame(cursor.fetchall())
-        query_data_df.columns = list(columns)
-        connection.close()
+        query_data_df = pd.DataFrame(cursor.fetchall(), columns=list(columns))
         cursor.close()
         return query_data_df
     except:
@@ -394,21 +1312,40 @@ def query_database(connection, query):
 
 
 # Builds query and retrieves data from database
-def retrieve_branch_manager_report_data(date_begin, date_end):
+# If partition_folder is set, data is streamed into branch partitions and
+# a dictionary of branch code to partition file is returned instead of a dataframe
+@timed_stage("retrieve_branch_manager_report_data")
+def retrieve_branch_manager_report_data(date_begin, date_end, chunk_size=None, partition_folder=None,
+                                        membership_filter=True):
     try:
         if not isinstance(date_begin, str):
             date_begin = str(date_begin)
         if not isinstance(date_end, str):
             date_end = str(date_end)
-        connection = connect_to_database(sql_details)
-        query_text, fields_dict = branch_manager_report_query(date_begin, date_end, query_fields_details)
-        data_df = query_database(connection, query_text)
+        query_text, query_params, fields_dict = branch_manager_report_query(date_begin, date_end,
+                                                                            query_fields_details, membership_filter)
+        with database_connection(sql_details) as connection:
+            if partition_folder:
+                data = query_database_to_branch_partitions(connection, query_text,
+                                                           chunk_size or default_chunk_size,
+                                                           fields_dict["branch_id"], partition_folder, query_params,
+                                                           fields_dict)
+                return data, fields_dict
+            data_df = query_database(connection, query_text, chunk_size, query_params, fields_dict)
         return data_df, fields_dict
     except:
         logging.error(log_template % (
             str(dt.datetime.now()), "Querying database failed", "retrieve_branch_manager_report_data"))
 
 
+# Current details, branch and role of the users with lessons in the date range, one row per user
+@timed_stage("retrieve_report_users")
+def retrieve_report_users(date_begin, date_end):
+    [query_text, query_params] = report_users_query(date_begin, date_end)
+    with database_connection(sql_details) as connection:
+        return query_database(connection, query_text, query_params=query_params)
+
+
 # Get date 15 weeks ago
 def last_15_weeks_range():
     try:
@@ -440,6 +1377,8 @@ def week_date_start_end(start_limit, end_limit):
             start_limit = dt.datetime(start_limit.year, start_limit.month, start_limit.day)
         if isinstance(end_limit, dt.date):
             end_limit = dt.datetime(end_limit.year, end_limit.month, end_limit.day)
+        import dateutil.rrule as rrule
+        import dateutil.relativedelta as relativedelta
         rule_sunday = rrule.rrule(rrule.WEEKLY, byweekday=relativedelta.SU, dtstart=start_limit)
         sundays = rule_sunday.between(start_limit, end_limit, inc=True)
         saturdays = [d + dt.timedelta(days=6) for d in sundays]
@@ -457,7 +1396,7 @@ def convert_track_opening(df, registered_col):
     try:
         registered_series_datetime = pd.to_datetime(df[registered_col])
         month = registered_series_datetime.dt.strftime("%b %y")
-        df[registered_col] = month
+        df[registered_col] = month.astype("category")
         return df
     except:
         logging.error(log_template % (
@@ -465,23 +1404,48 @@ def convert_track_opening(df, registered_col):
             "convert_track_opening"))
 
 
+# Week label as date range, e.g. 02/08/2020-08/08/2020
+def week_range_names(week_start_list, week_end_list):
+    return [str(dt.datetime.strftime(week_start, '%d/%m/%Y')) + "-" + str(
+        dt.datetime.strftime(week_end, '%d/%m/%Y')) for week_start, week_end in zip(week_start_list, week_end_list)]
+
+
+## Convert activity date to week ordinal
+# Parses the activity column once and locates each date in the Sunday-start weeks
+# with a binary search over the week starts. Dates outside all weeks get -1.
+def activity_week_index(data, activity_col, week_start_list, week_end_list):
+    try:
+        data[activity_col] = pd.to_datetime(data[activity_col])
+        activity_dates = data[activity_col].to_numpy(dtype="datetime64[ns]")
+        week_starts = np.array(week_start_list, dtype="datetime64[ns]")
+        week_ends = np.array(week_end_list, dtype="datetime64[ns]")
+        week_index = np.searchsorted(week_starts, activity_dates, side="right") - 1
+        in_range = (week_index >= 0) & (activity_dates <= week_ends[np.clip(week_index, 0, None)])
+        data[week_index_col] = np.where(in_range, week_index, -1)
+        return data
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Converting activity date to week index",
+            "activity_week_index"))
+
+
+# Adds the week ordinal column only if it was not computed upstream
+def ensure_week_index(data, activity_col, week_start_list, week_end_list):
+    if week_index_col not in data.columns:
+        data = activity_week_index(data, activity_col, week_start_list, week_end_list)
+    return data
+
+
 ## Count active users in the given date range
+@timed_stage("activity_total")
 def activity_total(data, activity_col, userid_col, week_start_list, week_end_list, result_name):
     try:
-        data[activity_col] = data[activity_col].apply(pd.to_datetime)
-        cols = []
-        results = []
-        for i in range(len(week_start_list)):
-            mask = (week_start_list[i] <= data[activity_col]) & (data[activity_col] <= week_end_list[i])
-            active_in_range = data[userid_col][mask]
-            col_name = str(dt.datetime.strftime(week_start_list[i], '%d/%m/%Y')) + "-" + str(
-                dt.datetime.strftime(week_end_list[i], '%d/%m/%Y'))
-            results.append(active_in_range.unique().size)
-            cols.append(col_name)
-        result_df = pd.DataFrame(results)
-        result_df.index = cols
-        result_df.rename(columns={0: result_name}, inplace=True)
-        result_df = result_df.transpose()
+        data = ensure_week_index(data, activity_col, week_start_list, week_end_list)
+        in_range = data[week_index_col] >= 0
+        results = data.loc[in_range].groupby(week_index_col)[userid_col].nunique()
+        results = results.reindex(range(len(week_start_list)), fill_value=0)
+        result_df = pd.DataFrame([results.to_numpy()], index=[result_name],
+                                 columns=week_range_names(week_start_list, week_end_list))
         return result_df
     except:
         logging.error(log_template % (
@@ -490,39 +1454,78 @@ def activity_total(data, activity_col, userid_col, week_start_list, week_end_lis
 
 
 ## Count active users by track in the given date range
+@timed_stage("activity_by_track")
 def activity_by_track(data, track_col, activity_col, userid_col, week_start_list, week_end_list):
     try:
-        result_df = pd.DataFrame()
-        tracks = data[track_col].unique()
-        tracks = np.sort(tracks)
-        for track in tracks:
-            data[track_col]
-            mask1 = (data[track_col] == track)
-            track_data = data.loc[mask1].copy(deep=True)
-            result_name = track
-            df = activity_total(data=track_data, activity_col=activity_col, week_start_list=week_start_list,
-                                userid_col=userid_col, week_end_list=week_end_list, result_name=result_name)
-            result_df = pd.concat([result_df, df.transpose()], axis=1)
-        return result_df.transpose()
+        data = ensure_week_index(data, activity_col, week_start_list, week_end_list)
+        tracks = np.sort(np.asarray(data[track_col].unique(), dtype=object))
+        in_range = data[week_index_col] >= 0
+        result_df = data.loc[in_range].groupby([track_col, week_index_col], observed=True)[userid_col].nunique()
+        result_df = result_df.unstack(fill_value=0)
+        result_df = result_df.reindex(index=tracks, columns=range(len(week_start_list)), fill_value=0)
+        result_df.columns = week_range_names(week_start_list, week_end_list)
+        result_df.index.name = None
+        return result_df
     except:
         logging.error(log_template % (
             str(dt.datetime.now()), "Counting all users active in date range by track",
             "activity_by_track"))
 
 
+## Count active users for every branch, track and week in a single pass
+# Output - totals per branch and totals per branch and track, columns are the week labels.
+# Rows outside the date range are kept in the grouping so tracks without activity in range still get a row of zeros.
+@timed_stage("branch_activity_counts")
+def branch_activity_counts(activity_df, fields_dict, track_col, activity_col, userid_col, week_start_list,
+                           week_end_list):
+    try:
+        data = ensure_week_index(activity_df, activity_col, week_start_list, week_end_list)
+        branch_col = fields_dict["branch_id"]
+        week_names = week_range_names(week_start_list, week_end_list)
+        weeks = range(len(week_start_list))
+
+        totals = data.groupby([branch_col, week_index_col], observed=True)[userid_col].nunique().unstack(fill_value=0)
+        totals = totals.reindex(columns=weeks, fill_value=0)
+        totals.columns = week_names
+
+        by_track = data.groupby([branch_col, track_col, week_index_col], observed=True)[userid_col].nunique().unstack(
+            fill_value=0)
+        by_track = by_track.sort_index()  # observed=True keeps categories in order of appearance
+        by_track = by_track.reindex(columns=weeks, fill_value=0)
+        by_track.columns = week_names
+        return totals, by_track
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Counting users active in date range for all branches",
+            "branch_activity_counts"))
+
+
+# Reads a single branch slice from the precomputed counts
+def branch_counts_slice(branch_counts, branch_code, result_name):
+    totals, by_track = branch_counts
+    all_participants_df = totals.loc[[branch_code]]
+    all_participants_df.index = [result_name]
+    by_track_all_participants_df = by_track.xs(branch_code, level=0)
+    by_track_all_participants_df.index.name = None
+    return all_participants_df, by_track_all_participants_df
+
+
+# Restricts the precomputed counts to a single branch, so only its rows are passed around
+def branch_counts_for(branch_counts, branch_code):
+    if branch_counts is None:
+        return None
+    totals, by_track = branch_counts
+    return totals.loc[totals.index == branch_code], by_track.loc[by_track.index.get_level_values(0) == branch_code]
+
+
 # Convert activity date to week
 # Adds week label as date range in a new column
 def activity_by_user(data, activity_col, userid_col, week_start_list, week_end_list):
     try:
-        data[activity_col] = data[activity_col].apply(pd.to_datetime)
-        data["lesson_week"] = ""
-        all_week_names = []
-        for i in range(len(week_start_list)):
-            mask = (week_start_list[i] <= data[activity_col]) & (data[activity_col] <= week_end_list[i])
-            date_range_name = str(dt.datetime.strftime(week_start_list[i], '%d/%m/%Y')) + "-" + str(
-                dt.datetime.strftime(week_end_list[i], '%d/%m/%Y'))
-            all_week_names.append(date_range_name)
-            data.loc[mask, "lesson_week"] = date_range_name
+        data = ensure_week_index(data, activity_col, week_start_list, week_end_list)
+        all_week_names = week_range_names(week_start_list, week_end_list)
+        week_labels = np.array(all_week_names + [""], dtype=object)  # -1 (out of range) picks the empty label
+        data["lesson_week"] = week_labels[data[week_index_col].to_numpy()]
         return data, all_week_names
     except:
         logging.error(log_template % (
@@ -530,55 +1533,122 @@ def activity_by_user(data, activity_col, userid_col, week_start_list, week_end_l
             "activity_by_user"))
 
 
-# Converts role name to Yes/No staff
+# Memory used by a dataframe in MB, including the contents of object columns
+def dataframe_memory_mb(data_df):
+    return data_df.memory_usage(deep=True).sum() / (1024 * 1024)
+
+
+# Casts the fetched activity columns to compact types - repeated strings to category,
+# IDs and lesson numbers to the smallest integer type and dates to datetime64.
+# Columns missing from the data (e.g. lessonDate in the aggregated query mode) are skipped.
+def compact_activity_types(data_df, fields_dict):
+    category_cols = [fields_dict["user_first_name"], fields_dict["user_last_name"], fields_dict["email"],
+                     fields_dict["branch"], fields_dict["role"], "track"]
+    integer_cols = ["userID", "lessonNo", fields_dict["branch_id"], fields_dict["role_ID"]]
+    date_cols = ["lessonDate", fields_dict["enroll"]]
+    for col in [col for col in integer_cols if col in data_df.columns]:
+        data_df[col] = pd.to_numeric(data_df[col], downcast="integer")  # Stays float if the column has NULLs
+    for col in [col for col in date_cols if col in data_df.columns]:
+        data_df[col] = pd.to_datetime(data_df[col])
+    for col in [col for col in category_cols if col in data_df.columns]:
+        data_df[col] = data_df[col].astype("category")
+    return data_df
+
+
+# Casts the activity data to compact types (already done batch by batch with --fetch_chunk)
+# Memory use before and after is written to the log.
+@timed_stage("enforce_activity_schema")
+def enforce_activity_schema(data_df, fields_dict):
+    try:
+        memory_before = dataframe_memory_mb(data_df)
+        data_df = compact_activity_types(data_df, fields_dict)
+        run_logger.info("%s activity data %d rows, memory %.2f MB -> %.2f MB" % (
+            str(dt.datetime.now()), len(data_df), memory_before, dataframe_memory_mb(data_df)))
+        return data_df
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Casting activity data to compact types",
+            "enforce_activity_schema"))
+
+
+# Converts role name to a boolean staff flag
+@timed_stage("convert_role")
 def convert_role(data_df, fields_dict, team_role_names_list):
     try:
-        dummy_table = pd.get_dummies(data_df[fields_dict["role"]])  # Turn role category into binary attribute column
-        data_df["team_member"] = False
-        for col in dummy_table.columns:
-            if col in team_role_names_list:
-                data_df["team_member"] = data_df["team_member"] | dummy_table[col].astype('bool')
-        data_df["team_member"] = data_df["team_member"].astype('str')
-        data_df = data_df.replace({"team_member": {'True': "Yes", 'False': "No"}})
+        data_df["team_member"] = data_df[fields_dict["role"]].isin(team_role_names_list)
         role_data = data_df.drop([fields_dict["role"], fields_dict["role_ID"]], axis=1)
         return role_data
     except:
         logging.error(log_template % (
-            str(dt.datetime.now()), "Converting role to Yes/No staff",
+            str(dt.datetime.now()), "Converting role to staff flag",
             "convert_role"))
 
 
+# Splits the activity data into a users dimension and a narrow fact table of user, track, date and lesson.
+# Name casing, staff flag and join month are computed once per user instead of once per lesson row.
+# Output - fact table and users table indexed by userID
+@timed_stage("split_user_dimension")
+def split_user_dimension(activity_df, fields_dict, team_role_names_list):
+    try:
+        user_cols = [fields_dict["user_first_name"], fields_dict["user_last_name"], fields_dict["email"],
+                     fields_dict["enroll"]]
+        role_cols = [fields_dict["role"], fields_dict["role_ID"]]
+        users_df = activity_df[["userID"] + user_cols + role_cols].drop_duplicates()
+        users_df = convert_role(users_df, fields_dict, team_role_names_list)
+        users_df = users_df.groupby("userID", observed=True).agg(
+            first_name=(fields_dict["user_first_name"], "first"),
+            last_name=(fields_dict["user_last_name"], "first"),
+            team_member=("team_member", "any"),  # Staff if any of the user's roles is a team role
+            email=(fields_dict["email"], "first"),
+            joined=(fields_dict["enroll"], "first"))
+        users_df["full name"] = users_df["first_name"].astype(str).str.title() + " " + \
+                                users_df["last_name"].astype(str).str.title()
+        users_df["email"] = users_df["email"].astype(str)
+        users_df = convert_track_opening(users_df, "joined")
+        users_df = users_df[["full name", "team_member", "email", "joined"]]
+        fact_df = activity_df.drop(columns=user_cols + role_cols)
+        return fact_df, users_df
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Splitting users from activity data",
+            "split_user_dimension"))
+
+
+# Restricts the users table to the users active in a branch slice
+def branch_users_for(users_df, df_branch):
+    if users_df is None or not isinstance(df_branch, pd.DataFrame):
+        return None
+    return users_df.loc[users_df.index.isin(df_branch["userID"].unique())]
+
+
 # Creates table to monitor learning progress for each user
-def progress_table_generator(df_branch_user, fields_dict, all_week_names):
-    try:
-        # concat values for pivot
-        df_branch_user["full_details"] = df_branch_user[fields_dict["user_first_name"]].str.title() + " " + \
-                                         df_branch_user[fields_dict["user_last_name"]].str.title() + "__" + \
-                                         df_branch_user["team_member"].astype(str) + "__" + df_branch_user[
-                                             fields_dict["email"]] + "__" + df_branch_user[fields_dict["enroll"]]
-        # Pivot
-        progress_table = pd.pivot_table(df_branch_user, values='lessonNo', index=["userID", "track", "full_details"],
-                                        columns=['lesson_week'], aggfunc=np.max)
-        # Editing for display
-        progress_table.reset_index(inplace=True)
+# report_date is the day the report is made for (default today)
+@timed_stage("progress_table_generator")
+def progress_table_generator(df_branch_user, users_df, all_week_names, report_date=None):
+    try:
+        # Max lesson per user, track and week - pivot on the user and track keys only
+        progress_table = df_branch_user.groupby(["userID", "track", "lesson_week"], observed=True)[
+            "lessonNo"].max().unstack("lesson_week").astype(float)
+        progress_table = progress_table.sort_index()  # observed=True keeps categories in order of appearance
+        progress_table.columns.name = None
         # Create summation columes based on pivot
-        attendance = progress_table.iloc[:, 3:].count(axis=1)
-        maxLesson = progress_table.iloc[:, 3:].max(axis=1).astype('str')
-        progress_table.fillna('', inplace=True)
-        # separate concatenated values for final display
-        details = progress_table["full_details"].str.split("__", expand=True)
-        progress_table.insert(1, "full name", details[0], allow_duplicates=False)
-        progress_table.insert(2, "staff", details[1], allow_duplicates=False)
-        progress_table.insert(3, "email", details[2], allow_duplicates=False)
-        progress_table.insert(4, "joined", details[3], allow_duplicates=False)
-        progress_table.insert(6, "attendance in last 15 weeks", attendance, allow_duplicates=False)
-        progress_table.insert(7, "Max lesson entered", maxLesson, allow_duplicates=False)
-        progress_table = progress_table.drop(columns=["userID", "full_details"], axis=1)
+        attendance = progress_table.count(axis=1)
+        maxLesson = progress_table.max(axis=1).astype('str')
+        progress_table = progress_table.fillna('')
+        # Join user attributes back for display
+        progress_table.insert(0, "attendance in last 15 weeks", attendance, allow_duplicates=False)
+        progress_table.insert(1, "Max lesson entered", maxLesson, allow_duplicates=False)
+        progress_table = progress_table.reset_index(level="track")
+        user_details = pd.DataFrame({"full name": users_df["full name"],
+                                     "staff": users_df["team_member"].map({True: "Yes", False: "No"}),
+                                     "email": users_df["email"], "joined": users_df["joined"].astype(str)})
+        progress_table = user_details.join(progress_table, how="inner")
+        progress_table = progress_table.reset_index(drop=True)
         cols = progress_table.columns[0:7].values.tolist() + all_week_names  # sort week ranges by order
 
-        if dt.date.today().isoweekday() != 7:
-            progress_table = progress_table.drop(columns=[""],
-                                                 axis=1)  # If report is not run on sunday sql date range in query is larger then week range. This removes attendance out of the date range.
+        if (report_date or dt.date.today()).isoweekday() != 7:
+            progress_table = progress_table.drop(columns=[""], axis=1,
+                                                 errors="ignore")  # If report is not run on sunday sql date range in query is larger then week range. This removes attendance out of the date range.
         else:
             cols = cols[
                    0:-2]  # If run on sunday Prevents range from including week that has just begun and has no data yet
@@ -590,13 +1660,30 @@ def progress_table_generator(df_branch_user, fields_dict, all_week_names):
             "progress_table_generator"))
 
 
+# Figure and axes shared by all charts, created on first use and cleared between charts
+# matplotlib is imported here so runs with SVG/HTML charts never load it
+def chart_axes():
+    if "axes" not in chart_figure_template:
+        import matplotlib
+        matplotlib.use("Agg")  # Non-interactive backend - charts are only saved to file
+        import matplotlib.figure
+        import matplotlib.backends.backend_agg
+        matplotlib.rcParams.update({'font.size': 18})
+        figure = matplotlib.figure.Figure(figsize=chart_size, dpi=chart_dpi)
+        matplotlib.backends.backend_agg.FigureCanvasAgg(figure)
+        chart_figure_template["figure"] = figure
+        chart_figure_template["axes"] = figure.add_subplot()
+    chart_figure_template["axes"].clear()
+    return chart_figure_template["figure"], chart_figure_template["axes"]
+
+
 # Generate branch summary graph
-def branch_summary_graph(table_totals, figure_name):
+@timed_stage("branch_summary_graph")
+def branch_summary_graph(table_totals, figure_target):
     try:
         # Generate graph
-        plt.rcParams.update({'font.size': 18})
-        table_totals.iloc[1:-1, :].transpose().plot(kind='bar', figsize=(40, 10))
-        current_ax = plt.gca()
+        figure, current_ax = chart_axes()
+        table_totals.iloc[1:-1, :].transpose().plot(kind='bar', ax=current_ax)
 
         x = table_totals.transpose().reset_index().reset_index()["level_0"]
         y = table_totals.transpose().reset_index().reset_index()["Total participants+staff"]
@@ -605,20 +1692,19 @@ def branch_summary_graph(table_totals, figure_name):
         for i, j in zip(x, y):
             current_ax.annotate(str(j), xy=(i, j))
 
-        plt.grid(True, which='both', axis='y')
-        plt.xticks(rotation=90)
-        plt.rcParams.update({'font.size': 18})
+        current_ax.grid(True, which='both', axis='y')
+        current_ax.tick_params(axis='x', labelrotation=90)
 
         z = np.polyfit(x, y, 1)
         p = np.poly1d(z)
-        plt.plot(x, p(x), "r--")
+        current_ax.plot(x, p(x), "r--")
         current_ax.legend(
             [table_totals.index.values.tolist()[0], "Trendline (Total P+S)"] + table_totals.index.values.tolist()[1:-1],
             loc='center left', bbox_to_anchor=(1, 0.5))
 
-        plt.tight_layout()
-        plt.savefig(figure_name)
-        plt.close()
+        figure.tight_layout()
+        # A file name gets the .png extension added, a buffer is written as png
+        figure.savefig(figure_target, dpi=chart_dpi, format=None if isinstance(figure_target, str) else "png")
 
     except:
         logging.error(log_template % (
@@ -626,6 +1712,148 @@ def branch_summary_graph(table_totals, figure_name):
             "branch_summary_graph"))
 
 
+# Branch summary chart as a small hand-built SVG - track bars, total line with values and total trendline.
+# Same rows as the PNG chart, without matplotlib. Attached as a file - Gmail strips SVG inlined in a message.
+@timed_stage("branch_summary_svg")
+def branch_summary_svg(table_totals, width=900, height=340):
+    try:
+        week_names = [str(week_name) for week_name in table_totals.columns]
+        totals = table_totals.iloc[0, :].to_numpy(dtype=float)
+        by_track = table_totals.iloc[1:-1, :]
+        [left, right, top, bottom] = [40, 170, 20, 120]  # Margins for axis values, legend and week labels
+        plot_width = width - left - right
+        plot_height = height - top - bottom
+        y_max = max(totals.max(), by_track.to_numpy(dtype=float).max() if by_track.size else 0, 1)
+        slot_width = plot_width / len(week_names)
+        bar_width = slot_width * 0.8 / max(len(by_track), 1)
+        centers = left + slot_width * (np.arange(len(week_names)) + 0.5)
+
+        def y_position(value):
+            return top + plot_height * (1 - value / y_max)
+
+        parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" viewBox="0 0 %d %d" '
+                 'font-family="sans-serif" font-size="10">' % (width, height, width, height)]
+        for level in np.linspace(0, y_max, 5):
+            parts.append('<line x1="%d" y1="%.1f" x2="%d" y2="%.1f" stroke="#ddd"/>' % (
+                left, y_position(level), left + plot_width, y_position(level)))
+            parts.append('<text x="%d" y="%.1f" text-anchor="end">%g</text>' % (
+                left - 4, y_position(level) + 3, round(level, 1)))
+        for track_no, (track, counts) in enumerate(by_track.iterrows()):
+            color = svg_colors[track_no % len(svg_colors)]
+            for week_no, count in enumerate(counts.to_numpy(dtype=float)):
+                parts.append('<rect x="%.1f" y="%.1f" width="%.1f" height="%.1f" fill="%s"/>' % (
+                    left + slot_width * (week_no + 0.1) + bar_width * track_no, y_position(count), bar_width,
+                    plot_height * count / y_max, color))
+        parts.append('<polyline fill="none" stroke="red" stroke-width="2" points="%s"/>' % " ".join(
+            "%.1f,%.1f" % (x, y_position(y)) for x, y in zip(centers, totals)))
+        for x, y in zip(centers, totals):
+            parts.append('<text x="%.1f" y="%.1f" text-anchor="middle">%g</text>' % (x, y_position(y) - 4, y))
+        if len(totals) > 1:
+            trend = np.poly1d(np.polyfit(np.arange(len(totals)), totals, 1))
+            parts.append('<line x1="%.1f" y1="%.1f" x2="%.1f" y2="%.1f" stroke="red" stroke-dasharray="6,4"/>' % (
+                centers[0], y_position(trend(0)), centers[-1], y_position(trend(len(totals) - 1))))
+        for x, week_name in zip(centers, week_names):
+            parts.append('<text transform="translate(%.1f,%d) rotate(-90)" text-anchor="end">%s</text>' % (
+                x + 3, top + plot_height + 4, html.escape(week_name)))
+        legend = [(table_totals.index[0], "red", "line"), ("Trendline (Total P+S)", "red", "dash")] + [
+            (track, svg_colors[track_no % len(svg_colors)], "bar") for track_no, track in enumerate(by_track.index)]
+        for entry_no, (label, color, kind) in enumerate(legend):
+            y = top + 14 * entry_no
+            if kind == "bar":
+                parts.append('<rect x="%d" y="%d" width="12" height="8" fill="%s"/>' % (width - right + 10, y, color))
+            else:
+                parts.append('<line x1="%d" y1="%d" x2="%d" y2="%d" stroke="%s"%s/>' % (
+                    width - right + 10, y + 4, width - right + 22, y + 4, color,
+                    ' stroke-dasharray="3,2"' if kind == "dash" else ''))
+            parts.append('<text x="%d" y="%d">%s</text>' % (width - right + 28, y + 8, html.escape(str(label))))
+        parts.append('</svg>')
+        return "".join(parts)
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Generating SVG graph",
+            "branch_summary_svg"))
+
+
+# Branch summary chart as plain HTML for the email body - Gmail strips inline <svg> from messages.
+# One row per week with the total, its trendline value and a bar per track, drawn as spans with inline widths.
+@timed_stage("branch_summary_html")
+def branch_summary_html(table_totals, bar_width=300):
+    try:
+        week_names = [str(week_name) for week_name in table_totals.columns]
+        totals = table_totals.iloc[0, :].to_numpy(dtype=float)
+        by_track = table_totals.iloc[1:-1, :]
+        value_max = max(totals.max(), by_track.to_numpy(dtype=float).max() if by_track.size else 0, 1)
+        week_numbers = np.arange(len(totals))
+        trend = np.poly1d(np.polyfit(week_numbers, totals, 1))(week_numbers) if len(totals) > 1 else totals
+        track_colors = [svg_colors[track_no % len(svg_colors)] for track_no in range(len(by_track))]
+
+        def bar(value, color):
+            return ('<div style="white-space:nowrap;line-height:10px"><span style="display:inline-block;height:8px;'
+                    'width:%dpx;background-color:%s"></span> %g</div>' % (
+                        round(bar_width * value / value_max), color, value))
+
+        cell = '<td style="padding:2px 6px;border-bottom:1px solid #ddd">%s</td>'
+        parts = ['<table dir="ltr" cellspacing="0" style="border-collapse:collapse;font-family:sans-serif;'
+                 'font-size:11px">',
+                 '<tr>' + "".join(cell % html.escape(heading) for heading in [
+                     "Week", str(table_totals.index[0]), "Trendline (Total P+S)", "By track"]) + '</tr>']
+        for week_no, week_name in enumerate(week_names):
+            track_bars = "".join(bar(count, color) for count, color in
+                                 zip(by_track.iloc[:, week_no].to_numpy(dtype=float), track_colors))
+            parts.append('<tr>' + cell % html.escape(week_name) + cell % bar(totals[week_no], "red") +
+                         cell % ("%.1f" % trend[week_no]) + cell % track_bars + '</tr>')
+        legend = " ".join('<span style="display:inline-block;width:10px;height:8px;background-color:%s"></span> %s' % (
+            color, html.escape(str(track))) for track, color in zip(by_track.index, track_colors))
+        parts.append('<tr><td colspan="4" style="padding:4px 6px">%s</td></tr></table>' % legend)
+        return "".join(parts)
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Generating HTML graph",
+            "branch_summary_html"))
+
+
+# Renders the summary chart repeatedly from a synthetic branch table and prints the time per chart
+# The first chart also creates the shared figure, so it is reported separately
+def benchmark_chart_rendering(start_week_dates, end_week_dates, repeats=20, chart_format="png"):
+    try:
+        week_names = week_range_names(start_week_dates, end_week_dates)
+        random_generator = np.random.default_rng(0)
+        tracks = ["Track %d" % track_no for track_no in range(6)]
+        by_track = pd.DataFrame(random_generator.integers(0, 40, (len(tracks), len(week_names))), index=tracks,
+                                columns=week_names)
+        totals = pd.DataFrame([by_track.sum().to_numpy()], index=["Total participants+staff"], columns=week_names)
+        table_totals = pd.concat([totals, by_track], axis=0)
+        chart_times = []
+        for run in range(repeats):
+            chart_start = time.perf_counter()
+            [chart_artifact, chart_html] = branch_summary_chart(table_totals, "chart %d" % run, chart_format)
+            chart_times.append(time.perf_counter() - chart_start)
+        chart_bytes = len(chart_artifact[1]) if chart_artifact else len(chart_html.encode("utf-8"))
+        chart_details = {"png": "%gx%g inches, %d dpi" % (chart_size[0], chart_size[1], chart_dpi),
+                         "svg": "hand-built SVG", "html": "HTML table"}[chart_format]
+        print("Summary chart %s (%s, %d bytes): %d charts, first %.3fs, median %.3fs, max %.3fs per chart" % (
+            chart_format, chart_details, chart_bytes, repeats, chart_times[0], float(np.median(chart_times)),
+            max(chart_times)))
+        return chart_times
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Benchmarking chart rendering", "benchmark_chart_rendering"))
+
+
+# Renders the branch summary chart in the requested format into memory
+# Output - (file name, content) chart to attach (None for html) and HTML to append to the email body
+def branch_summary_chart(table_totals, figure_name, chart_format="png"):
+    if chart_format == "png":
+        chart_buffer = io.BytesIO()
+        branch_summary_graph(table_totals, chart_buffer)
+        return (figure_name + ".png", chart_buffer.getvalue()), ""
+    if chart_format == "svg":
+        return (figure_name + ".svg", branch_summary_svg(table_totals).encode("utf-8")), ""
+    if chart_format == "html":
+        return None, "<div>" + branch_summary_html(table_totals) + "</div>"
+    raise ValueError("Unknown chart format " + str(chart_format))
+
+
 # Creates dataframe with data specific for a single branch
 def branch_specific_data(activity_df, branch_code, fields_dict):
     mask = (activity_df[fields_dict["branch_id"]] == branch_code)
@@ -633,74 +1861,368 @@ def branch_specific_data(activity_df, branch_code, fields_dict):
     return df_branch
 
 
-# Branch summary table - generation and save as csv
+# Splits activity into one dataframe per branch in a single groupby pass
+def split_by_branch(activity_df, fields_dict):
+    return {branch_code: df_branch for branch_code, df_branch in activity_df.groupby(fields_dict["branch_id"])}
+
+
+# Branch summary table - generation and serialization as csv
+# Output - table and its (file name, csv content) artifact
 def branch_summary_table(all_participants_df, by_track_all_participants_df, branch_name):
     table_totals = pd.concat([all_participants_df, by_track_all_participants_df], axis=0)
     table_totals_save_name = "Branch report for " + branch_name + ".csv"
-    save_as_csv(table_totals_save_name, table_totals)
-    return table_totals, table_totals_save_name
+    return table_totals, (table_totals_save_name, table_as_csv_bytes(table_totals))
 
 
-# Participant progress table  - generation and save as csv
-def user_progress_table(df_branch_user, all_week_names, branch_name, fields_dict):
+# Participant progress table  - generation and serialization as csv
+def user_progress_table(df_branch_user, users_df, all_week_names, branch_name, report_date=None):
     progress_table_save_name = branch_name + " branch member activity.csv"
-    progress_table = progress_table_generator(df_branch_user, fields_dict, all_week_names)
-    save_as_csv(progress_table_save_name, progress_table)
-    return progress_table, progress_table_save_name
-
-
-# Generate the three output files for each branch, then sends them
-# to the branch email address and copies it to AWS as backup
-def branch_report_generator(activity_df, start_week_dates, end_week_dates, fields_dict, output_folder_name,
-                            email_content, email_title,
-                            branch_code, branch_email):
+    progress_table = progress_table_generator(df_branch_user, users_df, all_week_names, report_date)
+    return progress_table, (progress_table_save_name, table_as_csv_bytes(progress_table))
+
+
+# Generate the three output files for a single branch in memory, copied to the output folder when save_files is set
+# activity_df may be a branch partition file, which is loaded and cleaned here
+# Output - artifact bundle with everything needed for delivery, None if rendering failed
+def branch_report_renderer(activity_df, start_week_dates, end_week_dates, fields_dict, output_folder_name,
+                           email_content, email_title,
+                           branch_code, branch_email, branch_counts=None, users_df=None, chart_format="png",
+                           save_files=True, archive=False, report_date=None):
+    render_start = time.perf_counter()
+    render_records = []  # Stage records of this job, returned with the bundle when rendered in a worker process
+    stage_context.branch_code = branch_code
+    stage_context.records = render_records
     try:
+        if isinstance(activity_df, str):
+            [activity_df, users_df] = prepare_activity_data(load_branch_partition(activity_df), fields_dict,
+                                                            start_week_dates, end_week_dates)
         df_branch = branch_specific_data(activity_df, branch_code, fields_dict)
         branch_name = str(df_branch[fields_dict["branch"]].iloc[0])
-        # Total participants accessing each track each week
-        all_participants_df = activity_total(data=df_branch, activity_col="lessonDate", userid_col="userID",
-                                             week_start_list=start_week_dates, week_end_list=end_week_dates,
-                                             result_name="Total participants+staff")
-        # Participants no accessing each track each week
-        by_track_all_participants_df = activity_by_track(data=df_branch, track_col="track", activity_col="lessonDate",
-                                                         userid_col="userID", week_start_list=start_week_dates,
-                                                         week_end_list=end_week_dates)
+        if branch_counts is not None:
+            # Counts precomputed for all branches - read this branch slice
+            [all_participants_df, by_track_all_participants_df] = branch_counts_slice(branch_counts, branch_code,
+                                                                                      "Total participants+staff")
+        else:
+            # Total participants accessing each track each week
+            all_participants_df = activity_total(data=df_branch, activity_col="lessonDate", userid_col="userID",
+                                                 week_start_list=start_week_dates, week_end_list=end_week_dates,
+                                                 result_name="Total participants+staff")
+            # Participants no accessing each track each week
+            by_track_all_participants_df = activity_by_track(data=df_branch, track_col="track",
+                                                             activity_col="lessonDate", userid_col="userID",
+                                                             week_start_list=start_week_dates,
+                                                             week_end_list=end_week_dates)
         # User specific progress each week in each track she accessed
         [df_branch_user, all_week_names] = activity_by_user(data=df_branch, activity_col="lessonDate",
                                                             userid_col="userID",
                                                             week_start_list=start_week_dates,
                                                             week_end_list=end_week_dates)
 
-        home_dir = os.getcwd()
-        if not os.path.exists(output_folder_name):
-            os.makedirs(output_folder_name)
-        os.chdir(output_folder_name)
-
-        # Branch summary table - generation and save as csv
-        [table_totals, table_totals_save_name] = branch_summary_table(all_participants_df, by_track_all_participants_df,
-                                                                      branch_name)
+        # Branch summary table - generation and serialization as csv
+        [table_totals, table_totals_artifact] = branch_summary_table(all_participants_df, by_track_all_participants_df,
+                                                                     branch_name)
 
-        # Branch summary figure - generation and save as png
+        # Branch summary figure - generation as png/svg or inline html
         figure_name = branch_name + " branch summary graph"
-        branch_summary_graph(table_totals, figure_name)
-
-        # Participant progress table  - generation and save as csv
-        [_, progress_table_save_name] = user_progress_table(df_branch_user, all_week_names, branch_name, fields_dict)
-
-        file_list = [table_totals_save_name, figure_name + ".png", progress_table_save_name]
-        send_email(branch_email, email_title, email_content, file_list)
-        os.chdir(home_dir)
-        transfer_to_aws(file_list, s3_details)
+        chart_start = time.perf_counter()
+        [chart_artifact, chart_html] = branch_summary_chart(table_totals, figure_name, chart_format)
+        chart_seconds = time.perf_counter() - chart_start
+
+        # Participant progress table  - generation and serialization as csv
+        [_, progress_table_artifact] = user_progress_table(df_branch_user, users_df, all_week_names, branch_name,
+                                                           report_date)
+
+        # Delivery reads the in-memory artifacts, the output folder copy is only kept for reference and reuse
+        artifacts = [artifact for artifact in [table_totals_artifact, chart_artifact, progress_table_artifact]
+                     if artifact is not None]
+        file_list = save_artifacts(artifacts, output_folder_name) if save_files else []
+        archive_rows = branch_archive_rows(table_totals, df_branch_user, branch_code, branch_name, start_week_dates,
+                                           end_week_dates) if archive else None
+        return {"branch_code": branch_code, "branch_email": branch_email, "email_title": email_title,
+                "email_content": email_content + chart_html, "artifacts": artifacts, "file_list": file_list,
+                "archive_rows": archive_rows,
+                "render_seconds": time.perf_counter() - render_start, "chart_seconds": chart_seconds,
+                "stage_records": render_records}
 
     except:
         logging.error(log_template_with_branch % (
             str(dt.datetime.now()), "Generating data",
-            "branch_report_generator", str(branch_code)))
+            "branch_report_renderer", str(branch_code)))
+    finally:
+        stage_context.branch_code = None
+        stage_context.records = None
+
+
+# Files of a bundle to deliver - the rendered in-memory artifacts, or the saved files of a reused bundle
+def bundle_attachments(bundle):
+    return bundle.get("artifacts") or bundle["file_list"]
+
+
+# Sends a rendered branch report to the branch email address and copies it to AWS as backup
+# Adds delivery status and latency to the artifact bundle. upload=False leaves the AWS copy to batch_upload_to_aws
+def deliver_branch_report(bundle, upload=True):
+    with branch_stage_context(bundle["branch_code"]):
+        email_start = time.perf_counter()
+        if bundle.get("already_sent"):
+            bundle["email_sent"] = True  # Same report was sent to the same address by an earlier run
+        else:
+            bundle["email_sent"] = send_email(bundle["branch_email"], bundle["email_title"], bundle["email_content"],
+                                              bundle_attachments(bundle))
+        bundle["email_seconds"] = time.perf_counter() - email_start
+        if upload:
+            upload_start = time.perf_counter()
+            bundle["uploaded"] = bundle.get("already_uploaded") or transfer_to_aws(bundle_attachments(bundle),
+                                                                                     s3_details)
+            bundle["upload_seconds"] = time.perf_counter() - upload_start
+    # Delivered bundles are kept until the end of the run - drop the report bytes unless the batch upload
+    # still needs them (no output folder copy to upload from)
+    if upload or bundle["file_list"]:
+        bundle.pop("artifacts", None)
+    bundle.pop("stage_records", None)  # Already merged into stage_records
+    return bundle
+
+
+# Batch mode - copies the files of all delivered branches to AWS in one pass at the end of the run
+@timed_stage("batch_upload_to_aws")
+def batch_upload_to_aws(delivered_bundles, s3_login_dict):
+    upload_start = time.perf_counter()
+    all_files = [single_file for bundle in delivered_bundles if not bundle.get("already_uploaded")
+                 for single_file in bundle_attachments(bundle)]
+    failed_files = set(upload_files_to_s3(all_files, s3_login_dict))
+    upload_seconds = (time.perf_counter() - upload_start) / max(len(delivered_bundles), 1)
+    for bundle in delivered_bundles:
+        bundle["uploaded"] = not failed_files.intersection(bundle_attachments(bundle))
+        bundle["upload_seconds"] = upload_seconds  # Batch time is shared evenly between branches
+        bundle.pop("artifacts", None)
+    return delivered_bundles
+
+
+# Generate the three output files for each branch, then sends them
+# to the branch email address and copies it to AWS as backup
+def branch_report_generator(activity_df, start_week_dates, end_week_dates, fields_dict, output_folder_name,
+                            email_content, email_title,
+                            branch_code, branch_email, branch_counts=None, users_df=None, chart_format="png",
+                            save_files=True):
+    bundle = branch_report_renderer(activity_df, start_week_dates, end_week_dates, fields_dict, output_folder_name,
+                                    email_content, email_title, branch_code, branch_email, branch_counts, users_df,
+                                    chart_format, save_files)
+    if bundle is None:
+        return False
+    bundle = deliver_branch_report(bundle)
+    return bundle["email_sent"] and bundle["uploaded"]
+
+
+# Render worker process initializer - loads the config, and traces memory as the main process does (--profile)
+def render_worker_init(file_name, trace_memory):
+    load_config(file_name)
+    if trace_memory:
+        tracemalloc.start()
+
+
+# Render stage - yields (branch code, artifact bundle) as branches finish rendering.
+# With several workers, at most two jobs per worker are in flight so rendered bundles
+# cannot pile up faster than they are consumed.
+def render_branch_reports(report_jobs, workers):
+    if workers <= 1:
+        for branch_code, job_kwargs in report_jobs:
+            yield branch_code, branch_report_renderer(**job_kwargs)
+        return
+
+    jobs = iter(report_jobs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=render_worker_init,
+                                                initargs=(config_file_name, tracemalloc.is_tracing())) as executor:
+        pending = {executor.submit(branch_report_renderer, **job_kwargs): branch_code
+                   for branch_code, job_kwargs in itertools.islice(jobs, 2 * workers)}
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                branch_code = pending.pop(future)
+                try:
+                    bundle = future.result()
+                except:
+                    logging.error(log_template_with_branch % (
+                        str(dt.datetime.now()), "Rendering worker",
+                        "render_branch_reports", str(branch_code)))
+                    bundle = None
+                if bundle is not None:
+                    with stage_records_lock:
+                        stage_records.extend(bundle["stage_records"])  # Recorded in the worker process
+                for next_code, next_kwargs in itertools.islice(jobs, 1):
+                    pending[executor.submit(branch_report_renderer, **next_kwargs)] = next_code
+                yield branch_code, bundle
+
+
+# Delivery stage - sends bundles from the queue until it receives None
+def delivery_worker(delivery_queue, delivered_bundles, upload=True):
+    while True:
+        bundle = delivery_queue.get()
+        if bundle is None:
+            break
+        delivered_bundles.append(deliver_branch_report(bundle, upload))
+
+
+# Staged pipeline - rendering feeds a bounded queue consumed by delivery threads,
+# so rendering and email/S3 round-trips overlap. A full queue blocks rendering (backpressure).
+# ready_bundles (reused from an earlier run) go to delivery before any rendering starts.
+def branch_report_pipeline(report_jobs, workers, delivery_workers, upload=True, ready_bundles=()):
+    delivered_bundles = []
+    failed_renders = []
+    delivery_queue = queue.Queue(maxsize=2 * max(delivery_workers, 1))
+    delivery_threads = [threading.Thread(target=delivery_worker, args=(delivery_queue, delivered_bundles, upload),
+                                         daemon=True) for _ in range(delivery_workers)]
+    for thread in delivery_threads:
+        thread.start()
+    try:
+        for branch_code, bundle in itertools.chain(((bundle["branch_code"], bundle) for bundle in ready_bundles),
+                                                   render_branch_reports(report_jobs, workers)):
+            if bundle is None:
+                failed_renders.append(branch_code)
+            elif delivery_threads:
+                delivery_queue.put(bundle)
+            else:
+                delivered_bundles.append(deliver_branch_report(bundle, upload))
+    finally:
+        for _ in delivery_threads:
+            delivery_queue.put(None)
+        for thread in delivery_threads:
+            thread.join()
+    return delivered_bundles, failed_renders
+
+
+# Long form rows of a branch for the run archive - summary table counts, and max lesson per user, track and week
+# Output - (summary rows, progress rows), both keyed by branch and week
+def branch_archive_rows(table_totals, df_branch_user, branch_code, branch_name, start_week_dates, end_week_dates):
+    week_starts = {week_name: week_start.date() for week_name, week_start in
+                   zip(week_range_names(start_week_dates, end_week_dates), start_week_dates)}
+    summary_rows = table_totals.rename_axis("row").reset_index().melt(id_vars="row", var_name="week",
+                                                                       value_name="count")
+    progress_rows = df_branch_user[df_branch_user["lesson_week"] != ""].groupby(
+        ["userID", "track", "lesson_week"], observed=True)["lessonNo"].max().reset_index()
+    progress_rows = progress_rows.rename(columns={"lesson_week": "week", "lessonNo": "max_lesson"})
+    for rows in (summary_rows, progress_rows):
+        rows.insert(0, "branch_code", branch_code)
+        rows.insert(1, "branch_name", branch_name)
+        rows.insert(2, "week_start", rows["week"].map(week_starts))
+    summary_rows["row"] = summary_rows["row"].astype(str)
+    progress_rows["track"] = progress_rows["track"].astype(str)  # Categories differ between branches
+    return summary_rows, progress_rows
+
+
+# Run archive - one zstd compressed Parquet file per table with the rows of all branches, sorted by branch and week.
+# Each branch is one row group, so readers filtering on branch skip the other branches' row groups.
+# Output - (file name, content) artifacts
+@timed_stage("run_archive_artifacts")
+def run_archive_artifacts(delivered_bundles):
+    import pyarrow
+    import pyarrow.parquet
+    archive_artifacts = []
+    for table_no, file_name in enumerate(archive_file_names):
+        frames = [bundle["archive_rows"][table_no] for bundle in delivered_bundles if bundle.get("archive_rows")]
+        if not frames:
+            continue
+        rows = pd.concat(frames, ignore_index=True).sort_values(["branch_code", "week_start"], kind="stable")
+        schema = pyarrow.Schema.from_pandas(rows, preserve_index=False)
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.parquet.ParquetWriter(sink, schema, compression="zstd") as writer:
+            for _, branch_rows in rows.groupby("branch_code", sort=True):
+                writer.write_table(pyarrow.Table.from_pandas(branch_rows, schema=schema, preserve_index=False))
+        archive_artifacts.append((file_name, sink.getvalue().to_pybytes()))
+    return archive_artifacts
+
+
+# Per-branch render, email and upload latency of a run
+def pipeline_summary(delivered_bundles, failed_renders):
+    summary_columns = ["branch", "render seconds", "chart seconds", "email seconds", "upload seconds", "email sent",
+                       "uploaded", "reused"]
+    rows = [[bundle["branch_code"], bundle["render_seconds"], bundle["chart_seconds"], bundle["email_seconds"],
+             bundle["upload_seconds"], bundle["email_sent"], bundle["uploaded"], bundle.get("reused", False)]
+            for bundle in delivered_bundles]
+    rows += [[branch_code, np.nan, np.nan, np.nan, np.nan, False, False, False] for branch_code in failed_renders]
+    summary = pd.DataFrame(rows, columns=summary_columns).sort_values("branch").set_index("branch")
+    return summary.round(3)
+
+
+# Content hash of a file, read in blocks
+def file_content_hash(file_name, algorithm="sha256"):
+    digest = hashlib.new(algorithm)
+    with open(file_name, "rb") as content_file:
+        for block in iter(lambda: content_file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Content hash of a branch report's inputs - activity slice (or partition file), users, counts, week range and
+# chart format. Row order of the activity slice does not change the hash.
+def branch_input_hash(branch_slice, users_df, branch_counts, start_week_dates, end_week_dates, chart_format):
+    digest = hashlib.sha256()
+    if isinstance(branch_slice, str):
+        for part_file in branch_partition_parts(branch_slice):
+            digest.update(file_content_hash(part_file).encode())
+    elif branch_slice is not None:
+        digest.update(np.sort(pd.util.hash_pandas_object(branch_slice, index=False).to_numpy()).tobytes())
+    for frame in [users_df] + list(branch_counts or []):
+        if frame is not None:
+            digest.update(pd.util.hash_pandas_object(frame, index=True).to_numpy().tobytes())
+    digest.update(json.dumps([week_range_names(start_week_dates, end_week_dates), chart_format]).encode())
+    return digest.hexdigest()
+
+
+# Manifest of the last run - input hash, output file hashes and delivery status per branch
+def load_artifact_manifest(folder_name):
+    try:
+        with open(os.path.join(folder_name, artifact_manifest_name)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}  # First run, or unreadable manifest - render everything
+
+
+def save_artifact_manifest(folder_name, manifest):
+    try:
+        with open(os.path.join(folder_name, artifact_manifest_name), "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Saving artifact manifest",
+            "save_artifact_manifest"))
+
+
+# Bundle rebuilt from the manifest when the branch inputs are unchanged and its files are still intact
+# Output - bundle ready for delivery, None if the branch has to be rendered
+def reused_branch_bundle(manifest_entry, input_hash, branch_code, branch_email, email_title):
+    if not manifest_entry or manifest_entry["input_hash"] != input_hash:
+        return None
+    for file_name, file_hash in manifest_entry["files"].items():
+        if not os.path.exists(file_name) or file_content_hash(file_name) != file_hash:
+            return None
+    return {"branch_code": branch_code, "branch_email": branch_email, "email_title": email_title,
+            "email_content": manifest_entry["email_content"], "file_list": list(manifest_entry["files"]),
+            "render_seconds": 0.0, "chart_seconds": 0.0, "stage_records": [], "reused": True,
+            "already_sent": manifest_entry["email_sent"] and manifest_entry["branch_email"] == branch_email,
+            "already_uploaded": manifest_entry["uploaded"]}
+
+
+# Records the inputs, output file hashes and delivery status of the delivered branches
+# Branches rendered without an output folder copy have nothing to reuse and are dropped
+def update_artifact_manifest(manifest, delivered_bundles, input_hashes, failed_renders):
+    for branch_code in failed_renders:
+        manifest.pop(str(branch_code), None)
+    for bundle in delivered_bundles:
+        if not bundle["file_list"]:
+            manifest.pop(str(bundle["branch_code"]), None)
+            continue
+        manifest[str(bundle["branch_code"])] = {
+            "input_hash": input_hashes[bundle["branch_code"]],
+            "files": {file_name: file_content_hash(file_name) for file_name in bundle["file_list"]},
+            "email_title": bundle["email_title"], "email_content": bundle["email_content"],
+            "branch_email": bundle["branch_email"], "email_sent": bool(bundle["email_sent"]),
+            "uploaded": bool(bundle["uploaded"]), "updated": str(dt.datetime.now())}
+    return manifest
 
 
 # Get branches and emails from JSON
 def retrieve_all_branch_codes_and_emails(url):
     try:
+        import urllib3
         http = urllib3.PoolManager()
         response = http.request('GET', url)
         data = json.loads(response.data.decode('utf-8'))
@@ -711,9 +2233,8 @@ def retrieve_all_branch_codes_and_emails(url):
             "retrieve_all_branch_codes_and_emails"))
 
 
-# Loop over all branches to generate all their reports and send to each branch email
-def generate_report_for_all_branches(activity_df, start_week_dates, end_week_dates, fields_dict, email_title,
-                                     email_content, email=""):
+# Branches that get a report - id, name and email, without the branches that study offline
+def report_branch_data():
     branch_data_list = retrieve_all_branch_codes_and_emails(branch_data_url)
 
     # TODO: remove next two lines when live
@@ -726,39 +2247,451 @@ def generate_report_for_all_branches(activity_df, start_week_dates, end_week_dat
             branch_data["branch_type"] == 7)  # NG branches and Haredi branches which study offline
     branch_data = branch_data.loc[~mask, ['id', "branch_name", "branch_email"]]
     branch_data.dropna(inplace=True)
+    return branch_data
+
+
+# Loop over all branches to generate all their reports and send to each branch email
+def generate_report_for_all_branches(activity_df, start_week_dates, end_week_dates, fields_dict, email_title,
+                                     email_content, email="", workers=1, delivery_workers=2, s3_batch=False,
+                                     branch_partitions=None, precomputed_counts=None, users_df=None,
+                                     chart_format="png", skip_unchanged=False, save_files=True, archive=False):
+    branch_data = report_branch_data()
     try:
-        if email == '':
-            for inx, row in branch_data.iterrows():
-                branch_report_generator(activity_df, start_week_dates, end_week_dates, fields_dict, output_folder_name,
-                                        email_content=email_content, email_title=email_title % row["branch_name"],
-                                        branch_code=int(row["id"]), branch_email=row["branch_email"])
+        if branch_partitions is None:
+            # Precompute stage - counts and branch slices for all branches at once
+            if precomputed_counts is not None:
+                branch_counts = precomputed_counts
+            else:
+                branch_counts = branch_activity_counts(activity_df, fields_dict, track_col="track",
+                                                       activity_col="lessonDate", userid_col="userID",
+                                                       week_start_list=start_week_dates,
+                                                       week_end_list=end_week_dates)
+            branch_slices = split_by_branch(activity_df, fields_dict)
+            no_activity = activity_df.iloc[0:0]
         else:
-            for inx, row in branch_data.iterrows():
-                branch_report_generator(activity_df, start_week_dates, end_week_dates, fields_dict, output_folder_name,
-                                        email_content=email_content,
-                                        email_title=email_title % row["branch_name"],
-                                        branch_code=int(row["id"]), branch_email=email)
+            # Streamed partitions - each branch is loaded and counted by its own render job
+            branch_counts = None
+            branch_slices = branch_partitions
+            no_activity = None
+        manifest = load_artifact_manifest(output_folder_name)
+        input_hashes = {}
+        report_jobs = []
+        reused_bundles = []
+        for inx, row in branch_data.iterrows():
+            branch_code = int(row["id"])
+            branch_slice = branch_slices.get(branch_code, no_activity)
+            branch_email = row["branch_email"] if email == '' else email
+            job_kwargs = dict(
+                activity_df=branch_slice, start_week_dates=start_week_dates,
+                end_week_dates=end_week_dates, fields_dict=fields_dict, output_folder_name=output_folder_name,
+                email_content=email_content, email_title=email_title % row["branch_name"], branch_code=branch_code,
+                branch_email=branch_email,
+                branch_counts=branch_counts_for(branch_counts, branch_code),
+                users_df=branch_users_for(users_df, branch_slice), chart_format=chart_format,
+                save_files=save_files, archive=archive)
+            input_hashes[branch_code] = branch_input_hash(branch_slice, job_kwargs["users_df"],
+                                                          job_kwargs["branch_counts"], start_week_dates,
+                                                          end_week_dates, chart_format)
+            reused_bundle = reused_branch_bundle(manifest.get(str(branch_code)), input_hashes[branch_code],
+                                                 branch_code, branch_email,
+                                                 job_kwargs["email_title"]) if skip_unchanged and not archive else None
+            if reused_bundle is not None:
+                reused_bundles.append(reused_bundle)
+            else:
+                report_jobs.append((branch_code, job_kwargs))
+
+        # Each render job receives only its own branch slice, users and counts
+        [delivered_bundles, failed_renders] = branch_report_pipeline(report_jobs, workers, delivery_workers,
+                                                                     upload=not s3_batch,
+                                                                     ready_bundles=reused_bundles)
+        if s3_batch:
+            delivered_bundles = batch_upload_to_aws(delivered_bundles, s3_details)
+        summary = pipeline_summary(delivered_bundles, failed_renders)
+        print(summary.to_string())
+        if not os.path.exists(output_folder_name):
+            os.makedirs(output_folder_name)  # Not created by rendering when report files stay in memory
+        save_as_csv(os.path.join(output_folder_name, "Run summary.csv"), summary)
+        save_artifact_manifest(output_folder_name, update_artifact_manifest(manifest, delivered_bundles,
+                                                                            input_hashes, failed_renders))
+        if archive:
+            # Run archive - tables of all rendered branches as a few large Parquet objects
+            run_date = str(dt.date.today())
+            archive_artifacts = run_archive_artifacts(delivered_bundles)
+            if save_files:
+                save_artifacts(archive_artifacts, os.path.join(output_folder_name, "archive", "run=" + run_date))
+            upload_run_archive(archive_artifacts, s3_details, run_date)
+        expire_s3_backups(s3_details)
+
+        failed_branches = failed_renders + [bundle["branch_code"] for bundle in delivered_bundles
+                                            if not (bundle["email_sent"] and bundle["uploaded"])]
+
+        if failed_branches:
+            logging.error(log_template % (
+                str(dt.datetime.now()), "Generating reports", "generate_report_for_all_branches") +
+                          ". Failed branches: " + ", ".join(str(code) for code in sorted(failed_branches)))
+        return failed_branches
     except:
         logging.error(log_template % (
             str(dt.datetime.now()), "Looping over all branches", 'generate_report_for_all_branches'))
 
 
+# Sunday that starts the week of the given date
+def week_start_of(date):
+    return date - dt.timedelta(days=date.isoweekday() % 7)
+
+
+# Cache file of the week starting on the given Sunday
+def week_cache_file(cache_folder, week_start):
+    return os.path.join(cache_folder, "week_" + week_start.strftime('%Y-%m-%d') + ".parquet")
+
+
+# Deletes cached weeks that ended before the report window
+def evict_week_cache(cache_folder, first_week_start):
+    oldest_kept = week_cache_file(cache_folder, first_week_start)
+    for file_name in os.listdir(cache_folder):
+        file_path = os.path.join(cache_folder, file_name)
+        if file_name.startswith("week_") and file_name.endswith(".parquet") and file_path < oldest_kept:
+            os.remove(file_path)
+
+
+# Date partitions covering date_begin to date_end, weeks_per_partition Sunday-start weeks each.
+# The first and last partitions are clipped to the range.
+def week_aligned_partitions(date_begin, date_end, weeks_per_partition=1):
+    [week_starts, _] = week_date_start_end(week_start_of(date_begin), date_end)
+    partitions = []
+    for first_week in range(0, len(week_starts), weeks_per_partition):
+        last_week = min(first_week + weeks_per_partition, len(week_starts)) - 1
+        partition_begin = max(week_starts[first_week].date(), date_begin)
+        partition_end = min(week_starts[last_week].date() + dt.timedelta(days=6), date_end)
+        partitions.append((partition_begin, partition_end))
+    return partitions
+
+
+# Retrieves the date range as Sunday aligned partitions, queried concurrently on separate pooled
+# connections (db_parallel at a time) and concatenated in date order
+def retrieve_partitioned_report_data(date_begin, date_end, db_parallel, weeks_per_partition=1, chunk_size=None,
+                                     membership_filter=True):
+    try:
+        partitions = week_aligned_partitions(date_begin, date_end, weeks_per_partition)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=db_parallel) as executor:
+            retrieved = list(executor.map(
+                lambda partition: retrieve_branch_manager_report_data(partition[0], partition[1], chunk_size,
+                                                                      membership_filter=membership_filter),
+                partitions))
+        if any(partition_data is None for partition_data in retrieved):
+            raise ValueError("Partition query failed")
+        data_df = pd.concat([partition_df for partition_df, _ in retrieved], ignore_index=True)
+        return data_df, retrieved[0][1]
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Retrieving date partitions", "retrieve_partitioned_report_data"))
+
+
+# Retrieves a date range with one query, or with concurrent partition queries when db_parallel > 1
+def retrieve_report_data_range(date_begin, date_end, chunk_size=None, db_parallel=1, weeks_per_partition=1,
+                               membership_filter=True):
+    if db_parallel > 1:
+        return retrieve_partitioned_report_data(date_begin, date_end, db_parallel, weeks_per_partition, chunk_size,
+                                                membership_filter)
+    return retrieve_branch_manager_report_data(date_begin, date_end, chunk_size,
+                                               membership_filter=membership_filter)
+
+
+# Retrieves the date range using a local cache of weekly Parquet partitions.
+# Closed weeks are read from the cache, missing and still open weeks are queried
+# from the database in a single range, and weeks older than the range are evicted.
+# refresh re-queries every week and rewrites the cache.
+# Only lesson facts are cached. Names, branch and role are joined from a fresh users query on every run,
+# so users who moved branch appear in their current branch for all weeks.
+def retrieve_with_weekly_cache(date_begin, date_end, cache_folder, refresh=False, chunk_size=None, db_parallel=1,
+                               weeks_per_partition=1):
+    try:
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+        [week_starts, week_ends] = week_date_start_end(week_start_of(date_begin), date_end)
+        today = dt.date.today()
+        weeks_to_fetch = [week_start for week_start, week_end in zip(week_starts, week_ends)
+                          if refresh or week_end.date() >= today
+                          or not os.path.exists(week_cache_file(cache_folder, week_start))]
+
+        fields_dict = query_fields_details
+        week_frames = []
+        if weeks_to_fetch:
+            fetch_begin = weeks_to_fetch[0].date()
+            fetch_end = min(weeks_to_fetch[-1].date() + dt.timedelta(days=6), date_end)
+            [fetched_df, fields_dict] = retrieve_report_data_range(fetch_begin, fetch_end, chunk_size, db_parallel,
+                                                                   weeks_per_partition, membership_filter=False)
+            fetched_df = fetched_df.loc[fetched_df["userID"].notna(), lesson_fact_columns]
+            fetched_df["userID"] = fetched_df["userID"].astype("int64")
+            fetched_dates = pd.to_datetime(fetched_df["lessonDate"])
+            fetched_week = fetched_dates - pd.to_timedelta((fetched_dates.dt.dayofweek + 1) % 7, unit="D")
+        for week_start, week_end in zip(week_starts, week_ends):
+            if weeks_to_fetch and weeks_to_fetch[0] <= week_start <= weeks_to_fetch[-1]:
+                week_df = fetched_df.loc[fetched_week == week_start]
+                if week_end.date() < today:
+                    week_df.to_parquet(week_cache_file(cache_folder, week_start), index=False)
+            else:
+                week_df = pd.read_parquet(week_cache_file(cache_folder, week_start))[lesson_fact_columns]
+            week_frames.append(week_df)
+        evict_week_cache(cache_folder, week_starts[0])
+
+        data_df = pd.concat(week_frames, ignore_index=True)
+        in_range = (data_df["lessonDate"] >= str(date_begin)) & (data_df["lessonDate"] <= str(date_end))
+        # Current membership - lessons of users no longer in a report branch are dropped by the inner join
+        users_df = retrieve_report_users(date_begin, date_end)
+        data_df = data_df.loc[in_range].merge(users_df, on="userID", how="inner")[report_query_columns]
+        return data_df.reset_index(drop=True), fields_dict
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Retrieving data through weekly cache", "retrieve_with_weekly_cache"))
+
+
 # Date range setup - true for all branches each week
-def retriev_data_from_last_four_months(date_four_months_ago, date_now):
+def retriev_data_from_last_four_months(date_four_months_ago, date_now, chunk_size=None, partition_folder=None,
+                                       cache_folder=None, refresh=False, db_parallel=1, weeks_per_partition=1):
     try:
         [start_week_dates, end_week_dates] = week_date_start_end(date_four_months_ago, date_now)
-        [activity_df, fields_dict] = retrieve_branch_manager_report_data(date_four_months_ago, date_now)
+        retrieved = None
+        if cache_folder and not partition_folder:
+            retrieved = retrieve_with_weekly_cache(date_four_months_ago, date_now, cache_folder, refresh, chunk_size,
+                                                   db_parallel, weeks_per_partition)
+        if retrieved is None and partition_folder:
+            retrieved = retrieve_branch_manager_report_data(date_four_months_ago, date_now, chunk_size,
+                                                            partition_folder)
+        elif retrieved is None:
+            retrieved = retrieve_report_data_range(date_four_months_ago, date_now, chunk_size, db_parallel,
+                                                   weeks_per_partition)
+        [activity_df, fields_dict] = retrieved
         return activity_df, fields_dict, start_week_dates, end_week_dates
     except:
         logging.error(log_template % (
             str(dt.datetime.now()), "Retrieving data", 'retriev_data_from_last_four_months'))
 
 
+# Data cleanup - true for all branches each week
+# Output - narrow activity fact table and the users dimension table
+def prepare_activity_data(activity_df, fields_dict, start_week_dates, end_week_dates):
+    activity_df = enforce_activity_schema(activity_df, fields_dict)
+    [activity_df, users_df] = split_user_dimension(activity_df, fields_dict, team_role_details)
+    activity_df = ensure_week_index(activity_df, "lessonDate", start_week_dates, end_week_dates)
+    return activity_df, users_df
+
+
+# Backfill - Sundays of the target weeks from the week of date_from to the week of date_to
+def backfill_target_weeks(date_from, date_to):
+    first_target = week_start_of(date_from)
+    num_targets = (week_start_of(date_to) - first_target).days // 7 + 1
+    return [first_target + dt.timedelta(weeks=week_no) for week_no in range(num_targets)]
+
+
+# Counts of one backfill window - its week columns of the counts over all backfilled weeks.
+# Tracks without activity in the window are dropped, as a run over the window alone would not see them.
+def window_counts(backfill_counts, first_week, num_weeks):
+    totals, by_track = backfill_counts
+    week_columns = totals.columns[first_week:first_week + num_weeks]
+    by_track = by_track[week_columns]
+    return totals[week_columns], by_track.loc[(by_track > 0).any(axis=1)]
+
+
+# Rows of a branch (sorted by week index) in one backfill window, with the week index moved to the window's weeks.
+# A regular run on the window's last Saturday queries from the Saturday before the window's first week, and the
+# lessons of that day count in "attendance in last 15 weeks" - they are kept, outside the week range (index -1).
+def window_branch_slice(df_branch, first_week, num_weeks, window_start):
+    [row_begin, row_end] = np.searchsorted(df_branch[week_index_col].to_numpy(),
+                                           [first_week - 1, first_week + num_weeks])
+    window_df = df_branch.iloc[row_begin:row_end]
+    day_before = pd.Timestamp(window_start - dt.timedelta(days=1))
+    in_window = (window_df[week_index_col] >= first_week) | (
+            (window_df["lessonDate"] >= day_before) & (window_df["lessonDate"] < pd.Timestamp(window_start)))
+    window_df = window_df.loc[in_window].copy()
+    window_df[week_index_col] = (window_df[week_index_col] - first_week).clip(lower=-1)
+    return window_df
+
+
+# Render jobs of all target weeks and branches, created as the renderer consumes them
+# Each report is made for the Saturday that ends its target week and saved in a folder per target week
+def backfill_report_jobs(target_weeks, start_week_dates, end_week_dates, backfill_counts, branch_slices, users_df,
+                         branch_data, fields_dict, chart_format):
+    for first_week, target_week in enumerate(target_weeks):
+        window_start_dates = start_week_dates[first_week:first_week + report_window_weeks]
+        window_end_dates = end_week_dates[first_week:first_week + report_window_weeks]
+        target_counts = window_counts(backfill_counts, first_week, report_window_weeks)
+        target_folder = os.path.join(output_folder_name, "Backfill " + target_week.strftime('%Y-%m-%d'))
+        for inx, row in branch_data.iterrows():
+            branch_code = int(row["id"])
+            if branch_code not in branch_slices:
+                continue
+            df_window = window_branch_slice(branch_slices[branch_code], first_week, report_window_weeks,
+                                            window_start_dates[0])
+            if df_window.empty:
+                continue  # No activity in this window - no report
+            yield (target_week, branch_code), dict(
+                activity_df=df_window, start_week_dates=window_start_dates, end_week_dates=window_end_dates,
+                fields_dict=fields_dict, output_folder_name=target_folder, email_content="", email_title="",
+                branch_code=branch_code, branch_email="", branch_counts=branch_counts_for(target_counts, branch_code),
+                users_df=branch_users_for(users_df, df_window), chart_format=chart_format,
+                report_date=target_week + dt.timedelta(days=6))
+
+
+# Backfill mode - regenerates the reports of every week from date_from to date_to in one pass.
+# The union of all 15 week windows is retrieved, cleaned, bucketed into weeks and counted once.
+# Each target week's window then slides over the shared weekly counts and the week sorted branch rows.
+# Files are saved per target week in the output folder, nothing is sent or uploaded.
+# Output - (target week, branch code) of the reports that failed
+def backfill_reports(date_from, date_to, chart_format="png", workers=1, chunk_size=None, refresh=False,
+                     db_parallel=1, weeks_per_partition=1):
+    try:
+        target_weeks = backfill_target_weeks(date_from, date_to)
+        # From the Saturday before the first window, as a regular run (last_15_weeks_range) on a Saturday
+        date_begin = target_weeks[0] - dt.timedelta(weeks=report_window_weeks - 1, days=1)
+        date_end = target_weeks[-1] + dt.timedelta(days=6)
+        [activity_df, fields_dict, start_week_dates, end_week_dates] = retriev_data_from_last_four_months(
+            date_begin, date_end, chunk_size, None, cache_folder_name, refresh, db_parallel, weeks_per_partition)
+        [activity_df, users_df] = prepare_activity_data(activity_df, fields_dict, start_week_dates, end_week_dates)
+        backfill_counts = branch_activity_counts(activity_df, fields_dict, track_col="track",
+                                                 activity_col="lessonDate", userid_col="userID",
+                                                 week_start_list=start_week_dates, week_end_list=end_week_dates)
+        branch_slices = {branch_code: df_branch.sort_values(week_index_col, kind="stable")
+                         for branch_code, df_branch in split_by_branch(activity_df, fields_dict).items()}
+        report_jobs = backfill_report_jobs(target_weeks, start_week_dates, end_week_dates, backfill_counts,
+                                           branch_slices, users_df, report_branch_data(), fields_dict, chart_format)
+        rendered = 0
+        failed_reports = []
+        for report_key, bundle in render_branch_reports(report_jobs, workers):
+            if bundle is None:
+                failed_reports.append(report_key)
+            else:
+                rendered += 1
+        print("Backfill %s - %s: %d weeks, %d reports saved, %d failed" % (
+            target_weeks[0], target_weeks[-1], len(target_weeks), rendered, len(failed_reports)))
+        if failed_reports:
+            logging.error(log_template % (
+                str(dt.datetime.now()), "Backfilling reports", "backfill_reports") + ". Failed reports: " +
+                          ", ".join("%s branch %s" % report_key for report_key in failed_reports))
+        return failed_reports
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Backfilling reports", "backfill_reports"))
+
+
+# Aggregated query mode - retrieves per user/track/week progress rows and per branch/track/week counts.
+# Output - progress rows in the shape of the activity data (with week index instead of lesson date)
+# and the precomputed branch counts
+@timed_stage("retrieve_aggregated_report_data")
+def retrieve_aggregated_report_data(date_begin, date_end, start_week_dates, end_week_dates):
+    try:
+        first_week_start = start_week_dates[0].strftime('%Y-%m-%d')
+        query_text, query_params, fields_dict = user_week_progress_query(str(date_begin), str(date_end),
+                                                                         first_week_start, query_fields_details)
+        with database_connection(sql_details) as connection:
+            progress_df = query_database(connection, query_text, query_params=query_params)
+        progress_df[week_index_col] = clip_week_index(progress_df["weekIndex"], len(start_week_dates))
+        progress_df = progress_df.drop(columns=["weekIndex"])
+
+        query_text, query_params, fields_dict = branch_week_counts_query(str(date_begin), str(date_end),
+                                                                         first_week_start, fields_dict)
+        with database_connection(sql_details) as connection:
+            counts_df = query_database(connection, query_text, query_params=query_params)
+        branch_counts = branch_counts_from_aggregate(counts_df, fields_dict, "track", start_week_dates,
+                                                     end_week_dates)
+        return progress_df, branch_counts, fields_dict
+    except:
+        logging.error(log_template % (
+            str(dt.datetime.now()), "Retrieving aggregated data", "retrieve_aggregated_report_data"))
+
+
+# Summary and progress tables of every branch, serialized as CSV text for comparison
+def branch_tables_as_csv(activity_df, users_df, branch_counts, fields_dict, start_week_dates, end_week_dates):
+    tables = {}
+    for branch_code, df_branch in split_by_branch(activity_df, fields_dict).items():
+        [all_participants_df, by_track_all_participants_df] = branch_counts_slice(branch_counts, branch_code,
+                                                                                  "Total participants+staff")
+        table_totals = pd.concat([all_participants_df, by_track_all_participants_df], axis=0)
+        [df_branch_user, all_week_names] = activity_by_user(data=df_branch.copy(), activity_col="lessonDate",
+                                                            userid_col="userID", week_start_list=start_week_dates,
+                                                            week_end_list=end_week_dates)
+        progress_table = progress_table_generator(df_branch_user, users_df, all_week_names)
+        tables[branch_code] = (table_totals.to_csv(), progress_table.to_csv())
+    return tables
+
+
+# Parity check - builds every branch table from the row level and from the aggregated query
+# Output - branches whose CSV output differs between the two modes
+def compare_query_modes(date_begin, date_end):
+    [activity_df, fields_dict, start_week_dates, end_week_dates] = retriev_data_from_last_four_months(
+        date_begin, date_end)
+    [activity_df, users_df] = prepare_activity_data(activity_df, fields_dict, start_week_dates, end_week_dates)
+    row_counts = branch_activity_counts(activity_df, fields_dict, track_col="track", activity_col="lessonDate",
+                                        userid_col="userID", week_start_list=start_week_dates,
+                                        week_end_list=end_week_dates)
+    row_tables = branch_tables_as_csv(activity_df, users_df, row_counts, fields_dict, start_week_dates,
+                                      end_week_dates)
+
+    [progress_df, aggregate_counts, fields_dict] = retrieve_aggregated_report_data(date_begin, date_end,
+                                                                                   start_week_dates, end_week_dates)
+    [progress_df, progress_users_df] = prepare_activity_data(progress_df, fields_dict, start_week_dates,
+                                                             end_week_dates)
+    aggregate_tables = branch_tables_as_csv(progress_df, progress_users_df, aggregate_counts, fields_dict,
+                                            start_week_dates, end_week_dates)
+
+    mismatched = sorted(branch_code for branch_code in set(row_tables) | set(aggregate_tables)
+                        if row_tables.get(branch_code) != aggregate_tables.get(branch_code))
+    return mismatched
+
+
+# Startup time of the -h and -a modes, each run in a fresh interpreter with -X importtime
+# Output - True if both finished within budget_ms milliseconds
+def startup_time_check(budget_ms=250):
+    within_budget = True
+    for option in ["-h", "-a"]:
+        run_start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime", os.path.abspath(__file__), option],
+                                capture_output=True, text=True)
+        elapsed_ms = (time.perf_counter() - run_start) * 1000
+        # importtime lines: "import time: self [us] | cumulative | package", nested packages are indented
+        import_times = [line.split("|") for line in result.stderr.splitlines() if line.startswith("import time:")]
+        top_level_imports = sorted(((int(cumulative), package.strip()) for _, cumulative, package in import_times
+                                    if cumulative.strip().isdigit() and not package.startswith("  ")), reverse=True)
+        slowest = ", ".join("%s %.0f ms" % (package, cumulative / 1000)
+                            for cumulative, package in top_level_imports[:5])
+        passed = result.returncode == 0 and elapsed_ms <= budget_ms
+        print("%s: %.0f ms (budget %d ms) %s - slowest imports: %s" % (
+            option, elapsed_ms, budget_ms, "OK" if passed else "OVER BUDGET", slowest))
+        within_budget = within_budget and passed
+    return within_budget
+
+
 def main(argv, email_title, email_content):
     test_email = ''
     branch_code = ''
+    workers = 1
+    delivery_workers = 2
+    local_smtp = False
+    s3_batch = False
+    chunk_size = None
+    partition_folder = ""
+    refresh = False
+    sql_aggregate = False
+    explain = False
+    time_query_runs = 0
+    db_parallel = 1
+    weeks_per_partition = 1
+    chart_benchmark_runs = 0
+    chart_format = "png"
+    profiler = None
+    skip_unchanged = False
+    save_files = True
+    archive = False
+    backfill_from = None
     try:
-        options, args = getopt.getopt(argv, "m:b:ha", ["test_email=", "branch_id="])
+        options, args = getopt.getopt(argv, "m:b:w:d:ha", ["test_email=", "branch_id=", "workers=",
+                                                           "delivery_workers=", "local_smtp", "s3_batch",
+                                                           "fetch_chunk=", "partition_folder=", "refresh",
+                                                           "sql_aggregate", "parity_check", "explain",
+                                                           "time_query=", "db_parallel=", "partition_weeks=",
+                                                           "chart_benchmark=", "chart_format=", "startup_check=",
+                                                           "profile", "skip_unchanged", "in_memory",
+                                                           "s3_archive", "backfill="])
     except getopt.GetoptError:
         print(
             "Test options requires input \n Use the form: branch_manager_report -t xxx@yyyy.zzz \n or Use the form: branch_manager_report -t xxx@yyyy.zzz -b #no")
@@ -771,43 +2704,183 @@ def main(argv, email_title, email_content):
         elif opt == "-h":
             print(help_text)
             sys.exit()
+        elif opt == "--startup_check":
+            sys.exit(0 if startup_time_check(int(arg)) else 1)
 
-    [date_four_months_ago, date_now] = last_15_weeks_range()
-    [activity_df, fields_dict, start_week_dates, end_week_dates] = retriev_data_from_last_four_months(
-        date_four_months_ago, date_now)
-
-    date_four_months_ago = date_four_months_ago.strftime("%d.%m.%Y")
-    date_now = date_now.strftime("%d.%m.%Y")
-    email_content = email_content % (str(date_now) + " - " + str(date_four_months_ago))
-
-    # Data cleanup - true for all branches each week
-    activity_df = convert_role(activity_df, fields_dict, team_role_details)
-    activity_df = convert_track_opening(activity_df, "dateJoined")
+    load_config(config_file_name)
 
     for opt, arg in options:
         if opt in ("-b"):
             branch_code = arg
         if opt in ("-m"):
             test_email = arg
+        if opt in ("-w", "--workers"):
+            workers = int(arg)
+        if opt in ("-d", "--delivery_workers"):
+            delivery_workers = int(arg)
+        if opt == "--local_smtp":
+            local_smtp = True
+        if opt == "--s3_batch":
+            s3_batch = True
+        if opt == "--fetch_chunk":
+            chunk_size = int(arg)
+        if opt == "--partition_folder":
+            partition_folder = arg
+        if opt == "--refresh":
+            refresh = True
+        if opt == "--sql_aggregate":
+            sql_aggregate = True
+        if opt == "--explain":
+            explain = True
+        if opt == "--time_query":
+            time_query_runs = int(arg)
+        if opt == "--db_parallel":
+            db_parallel = int(arg)
+        if opt == "--partition_weeks":
+            weeks_per_partition = int(arg)
+        if opt == "--chart_benchmark":
+            chart_benchmark_runs = int(arg)
+        if opt == "--chart_format":
+            chart_format = arg.lower()
+            if chart_format not in chart_formats:
+                print("Chart format must be one of: " + ", ".join(chart_formats))
+                sys.exit(2)
+        if opt == "--skip_unchanged":
+            skip_unchanged = True
+        if opt == "--in_memory":
+            save_files = False
+        if opt == "--s3_archive":
+            archive = True
+        if opt == "--backfill":
+            try:
+                date_from, _, date_to = arg.partition(":")
+                backfill_from = dt.datetime.strptime(date_from, "%Y-%m-%d").date()
+                backfill_to = dt.datetime.strptime(date_to, "%Y-%m-%d").date() if date_to else dt.date.today()
+            except ValueError:
+                print("Backfill dates must be given as FROM[:TO] in YYYY-MM-DD")
+                sys.exit(2)
+            if backfill_from > backfill_to:
+                print("Backfill FROM (%s) is after TO (%s)" % (backfill_from, backfill_to))
+                sys.exit(2)
+        if opt == "--profile":
+            import cProfile
+            profiler = cProfile.Profile()
 
-    if (branch_code == "") and (test_email == ""):
-        generate_report_for_all_branches(activity_df, start_week_dates, end_week_dates, fields_dict, email_title,
-                                         email_content)
+    [date_four_months_ago, date_now] = last_15_weeks_range()
+    if chart_benchmark_runs > 0:
+        benchmark_chart_rendering(*week_date_start_end(date_four_months_ago, date_now), chart_benchmark_runs,
+                                  chart_format)
         sys.exit()
-    elif branch_code == "":
-        generate_report_for_all_branches(activity_df, start_week_dates, end_week_dates, fields_dict, email_title,
-                                         email_content, email=test_email)
+    if explain:
+        query_text, query_params, _ = branch_manager_report_query(str(date_four_months_ago), str(date_now),
+                                                                  query_fields_details)
+        with database_connection(sql_details) as connection:
+            explain_query(connection, query_text, query_params)
         sys.exit()
-    elif test_email == "":
-        print("Branch ID cannot be input without report recipient Email address")
-    elif (not branch_code == "") and (not test_email == ""):
-        branch_report_generator(activity_df, start_week_dates, end_week_dates, fields_dict, output_folder_name,
-                                email_content, email_title=email_title % branch_code,
-                                branch_code=int(branch_code), branch_email=test_email)
+    if time_query_runs > 0:
+        time_range_query(date_four_months_ago, date_now, time_query_runs)
         sys.exit()
+    for opt, arg in options:
+        if opt == "--parity_check":
+            mismatched_branches = compare_query_modes(date_four_months_ago, date_now)
+            print("Row level and aggregated query modes differ for branches: " + str(mismatched_branches)
+                  if mismatched_branches else "Row level and aggregated query modes give identical tables")
+            sys.exit(1 if mismatched_branches else 0)
+
+    if profiler is not None:
+        tracemalloc.start()  # Own peak memory of each stage in the run report
+        profiler.enable()
+    if backfill_from is not None:
+        try:
+            failed_reports = backfill_reports(backfill_from, backfill_to, chart_format, workers, chunk_size, refresh,
+                                              db_parallel, weeks_per_partition)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                save_profile(profiler, output_folder_name)
+            save_run_report(output_folder_name)
+        sys.exit(0 if failed_reports == [] else 1)
+    precomputed_counts = None
+    if sql_aggregate:
+        # Weekly aggregation is done by MySQL, only aggregated rows are retrieved
+        partition_folder = ""
+        [start_week_dates, end_week_dates] = week_date_start_end(date_four_months_ago, date_now)
+        [activity_df, precomputed_counts, fields_dict] = retrieve_aggregated_report_data(
+            date_four_months_ago, date_now, start_week_dates, end_week_dates)
     else:
-        print(help_text)
+        [activity_df, fields_dict, start_week_dates, end_week_dates] = retriev_data_from_last_four_months(
+            date_four_months_ago, date_now, chunk_size, partition_folder, cache_folder_name, refresh, db_parallel,
+            weeks_per_partition)
 
+    date_four_months_ago = date_four_months_ago.strftime("%d.%m.%Y")
+    date_now = date_now.strftime("%d.%m.%Y")
+    email_content = email_content % (str(date_now) + " - " + str(date_four_months_ago))
+
+    branch_partitions = None
+    users_df = None
+    if partition_folder:
+        # Data was streamed into branch partitions - each is cleaned when its branch is rendered
+        branch_partitions = activity_df
+        activity_df = None
+        if branch_code != "":
+            branch_partition = branch_partitions.get(int(branch_code)) if branch_code.isdigit() else None
+            if branch_partition is None:
+                # Mistyped id, or no lessons of this branch in the date range
+                print("No activity for branch " + branch_code)
+                logging.error(log_template_with_branch % (
+                    str(dt.datetime.now()), "Loading branch partition", "main", branch_code) + ". No activity")
+                sys.exit(1)
+            [activity_df, users_df] = prepare_activity_data(load_branch_partition(branch_partition), fields_dict,
+                                                            start_week_dates, end_week_dates)
+    else:
+        # Data cleanup - true for all branches each week
+        [activity_df, users_df] = prepare_activity_data(activity_df, fields_dict, start_week_dates, end_week_dates)
+
+    # One pool of SMTP sessions for the whole run
+    local_smtp_server = None
+    local_smtp_port = None
+    if local_smtp:
+        [local_smtp_server, local_smtp_port] = start_local_smtp_server()
+    open_smtp_pool(email_details, pool_size=max(delivery_workers, 1), local_smtp_port=local_smtp_port)
+    try:
+        if (branch_code == "") and (test_email == ""):
+            generate_report_for_all_branches(activity_df, start_week_dates, end_week_dates, fields_dict, email_title,
+                                             email_content, workers=workers,
+                                             delivery_workers=delivery_workers, s3_batch=s3_batch,
+                                             branch_partitions=branch_partitions,
+                                             precomputed_counts=precomputed_counts, users_df=users_df,
+                                             chart_format=chart_format, skip_unchanged=skip_unchanged,
+                                             save_files=save_files, archive=archive)
+            sys.exit()
+        elif branch_code == "":
+            generate_report_for_all_branches(activity_df, start_week_dates, end_week_dates, fields_dict, email_title,
+                                             email_content, email=test_email, workers=workers,
+                                             delivery_workers=delivery_workers, s3_batch=s3_batch,
+                                             branch_partitions=branch_partitions,
+                                             precomputed_counts=precomputed_counts, users_df=users_df,
+                                             chart_format=chart_format, skip_unchanged=skip_unchanged,
+                                             save_files=save_files, archive=archive)
+            sys.exit()
+        elif test_email == "":
+            print("Branch ID cannot be input without report recipient Email address")
+        elif (not branch_code == "") and (not test_email == ""):
+            branch_report_generator(activity_df, start_week_dates, end_week_dates, fields_dict, output_folder_name,
+                                    email_content, email_title=email_title % branch_code,
+                                    branch_code=int(branch_code), branch_email=test_email,
+                                    branch_counts=branch_counts_for(precomputed_counts, int(branch_code)),
+                                    users_df=users_df, chart_format=chart_format, save_files=save_files)
+            sys.exit()
+        else:
+            print(help_text)
+    finally:
+        close_smtp_pool()
+        if local_smtp_server is not None:
+            print("Local SMTP server received %d emails" % local_smtp_server.messages_received)
+            local_smtp_server.shutdown()
+        if profiler is not None:
+            profiler.disable()
+            save_profile(profiler, output_folder_name)
+        save_run_report(output_folder_name)
 
 if __name__ == "__main__":
     main(sys.argv[1:], email_title, email_content)